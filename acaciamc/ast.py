@@ -108,7 +108,9 @@ class Expression(AST):
 # details
 
 class Module(AST):  # a module
-    def __init__(self, body: _List[Statement], lineno, col):
+    # `body` is an iterator that parses statements on demand if the
+    # module is read by `Parser.module_stream`.
+    def __init__(self, body: _Iterable[Statement], lineno, col):
         super().__init__(lineno, col)
         self.body = body
 
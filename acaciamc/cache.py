@@ -0,0 +1,184 @@
+"""
+Compilation cache for Acacia.
+
+A `CompileCache` is a directory in which `Compiler` keeps results of
+previous runs so that unchanged sources are not processed again:
+- Parse trees of Acacia sources (see `acaciamc.serializer`), keyed by
+  the hash of source code and Minecraft version.
+- Rendered output of whole builds, keyed by main file and `Config`,
+  along with hashes of every file that the build depends on.
+Cache entries are written atomically and a broken or outdated entry is
+simply treated as a miss.
+
+A `CompileCache` also remembers parse trees and the Python modules of
+binary modules in memory, so that compiling several entry files with
+the same cache (see `Compiler.batch`) parses and loads every shared
+module only once. A cache created without a directory only does this.
+"""
+
+__all__ = ["CompileCache", "BuildRecord", "CACHE_DIR_NAME", "file_digest"]
+
+from typing import (
+    Any, Dict, List, NamedTuple, Optional, Tuple, TYPE_CHECKING
+)
+from types import ModuleType
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+
+from acaciamc import __version__
+from acaciamc.serializer import dump_ast, load_ast, SerializeError
+
+if TYPE_CHECKING:
+    from acaciamc.ast import Module
+    from acaciamc.compiler import Config
+    from acaciamc.tools.versionlib import VERSION_T
+
+# Default name of cache directory, created next to main source file
+CACHE_DIR_NAME = "__acacache__"
+# Increase this when format of cache entries changes
+CACHE_FORMAT = 2
+
+# (leading dots, parent names, last name) of a `ModuleMeta`
+META_T = Tuple[int, Tuple[str, ...], str]
+
+class BuildRecord(NamedTuple):
+    # (path, digest) of every file the build read
+    dependencies: List[Tuple[str, str]]
+    # Module lookups done by the build and the paths they resolved to
+    imports: List[Tuple[META_T, str]]
+    # Output files: path relative to output directory -> content
+    files: Dict[str, str]
+
+def _hash(*parts: Any) -> str:
+    h = hashlib.sha1()
+    h.update(repr(
+        (__version__, CACHE_FORMAT, sys.version_info[:2])
+    ).encode("utf-8"))
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = repr(part).encode("utf-8")
+        h.update(b"\0")
+        h.update(part)
+    return h.hexdigest()
+
+def file_digest(path: str) -> Optional[str]:
+    """Return hash of content of file `path`, or None if unreadable."""
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+class CompileCache:
+    def __init__(self, directory: Optional[str] = None):
+        """
+        directory: where to persist cache entries; when None, results
+          are only shared in memory
+        """
+        self.directory = directory
+        # Parse trees that are shared in memory; they are never
+        # modified after parsing.
+        self._asts: Dict[str, "Module"] = {}
+        # (path, digest) -> executed Python module of binary module
+        self._binary_modules: Dict[Tuple[str, str], ModuleType] = {}
+
+    def _entry_path(self, kind: str, key: str) -> str:
+        return os.path.join(self.directory, kind, key)
+
+    def _load(self, kind: str, key: str) -> Optional[bytes]:
+        if self.directory is None:
+            return None
+        try:
+            with open(self._entry_path(kind, key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _store(self, kind: str, key: str, data: bytes):
+        if self.directory is None:
+            return
+        path = self._entry_path(kind, key)
+        folder = os.path.dirname(path)
+        try:
+            os.makedirs(folder, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=folder)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        except OSError:
+            # Failing to write cache should never break compilation.
+            pass
+
+    # --- Parse trees ---
+
+    @staticmethod
+    def ast_key(source: str, mc_version: "VERSION_T") -> str:
+        return _hash(source.encode("utf-8"), mc_version)
+
+    def load_ast(self, key: str) -> Optional["Module"]:
+        node = self._asts.get(key)
+        if node is not None:
+            return node
+        data = self._load("ast", key)
+        if data is None:
+            return None
+        try:
+            node = load_ast(data)
+        except SerializeError:
+            return None
+        self._asts[key] = node
+        return node
+
+    def store_ast(self, key: str, node: "Module"):
+        self._asts[key] = node
+        if self.directory is not None:
+            self._store("ast", key, dump_ast(node))
+
+    # --- Binary modules ---
+
+    def load_binary_module(self, path: str,
+                           digest: Optional[str]) -> Optional[ModuleType]:
+        """
+        Return the Python module of binary module at `path` with
+        content hash `digest` if it has been executed before.
+        """
+        if digest is None:
+            return None
+        return self._binary_modules.get((path, digest))
+
+    def store_binary_module(self, path: str, digest: Optional[str],
+                            module: ModuleType):
+        if digest is not None:
+            self._binary_modules[(path, digest)] = module
+
+    # --- Builds ---
+
+    @staticmethod
+    def build_key(main_path: str, cfg: "Config") -> str:
+        return _hash(os.path.realpath(main_path), tuple(cfg))
+
+    def load_build(self, key: str) -> Optional[BuildRecord]:
+        data = self._load("build", key)
+        if data is None:
+            return None
+        try:
+            res = pickle.loads(data)
+        except Exception:
+            # Truncated or incompatible entry
+            return None
+        if not isinstance(res, BuildRecord):
+            return None
+        return res
+
+    def store_build(self, key: str, record: BuildRecord):
+        if self.directory is None:
+            return
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self._store("build", key, data)
@@ -1,21 +1,33 @@
 """Command line interface of Acacia."""
 
-__all__ = ["build_argparser", "get_config", "run", "main"]
+__all__ = ["build_argparser", "get_config", "get_cache", "run", "main"]
 
+from typing import Dict, Iterable, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
 import argparse
+import json
 import os
-import shutil
 import sys
+import time
 
 from acaciamc.error import Error as CompileError
-from acaciamc.compiler import Compiler, Config
+from acaciamc.compiler import Compiler, Config, OutputStats, pack_manifest
+from acaciamc.cache import CompileCache, CACHE_DIR_NAME
 from acaciamc.localization import localize
+from acaciamc.mccmdgen.optimizer import Optimizer
 from acaciamc.tokenizer import is_idstart, is_idcontinue
 
 _NOTGIVEN = object()
+# Seconds between two checks for changes in watch mode
+WATCH_INTERVAL = 0.5
+# Cache of current process, when working as a `build_batch` worker
+_worker_cache: Optional[CompileCache] = None
 
-def fatal(message: str):
+def error(message: str):
     print(localize("cli.fatal") % message, file=sys.stderr)
+
+def fatal(message: str):
+    error(message)
     sys.exit(1)
 
 def build_argparser():
@@ -23,7 +35,7 @@ def build_argparser():
         prog='acacia', description=localize("cli.description"),
     )
     argparser.add_argument(
-        'file',
+        'file', nargs='+',
         help=localize("cli.argshelp.file")
     )
     argparser.add_argument(
@@ -87,10 +99,50 @@ def build_argparser():
         action='store_true',
         help=localize("cli.argshelp.verbose")
     )
+    argparser.add_argument(
+        '--stats',
+        action='store_true',
+        help=localize("cli.argshelp.stats")
+    )
     argparser.add_argument(
         '--max-inline-file-size', metavar="SIZE", type=int,
         help=localize("cli.argshelp.maxinline")
     )
+    argparser.add_argument(
+        '--disable-pass', metavar="NAME", action='append',
+        help=localize("cli.argshelp.disablepass")
+        % ", ".join(Optimizer.pass_names())
+    )
+    argparser.add_argument(
+        '--call-profile', metavar="FILE",
+        help=localize("cli.argshelp.callprofile")
+    )
+    argparser.add_argument(
+        '-c', '--cache', nargs='?', metavar='DIR', const=_NOTGIVEN,
+        help=localize("cli.argshelp.cache") % CACHE_DIR_NAME
+    )
+    argparser.add_argument(
+        '--output-workers', metavar="N", type=int, default=1,
+        help=localize("cli.argshelp.outputworkers")
+    )
+    argparser.add_argument(
+        '-j', '--jobs', metavar="N", type=int, default=1,
+        help=localize("cli.argshelp.jobs")
+    )
+    argparser.add_argument(
+        '-a', '--archive',
+        action='store_true',
+        help=localize("cli.argshelp.archive")
+    )
+    argparser.add_argument(
+        '--pack-manifest', metavar="NAME",
+        help=localize("cli.argshelp.packmanifest")
+    )
+    argparser.add_argument(
+        '-w', '--watch',
+        action='store_true',
+        help=localize("cli.argshelp.watch")
+    )
     return argparser
 
 def check_id(name: str):
@@ -154,6 +206,15 @@ def get_config(args) -> Config:
             fatal(localize("cli.getconfig.maxinlinetoolow")
                   % args.max_inline_file_size)
         kwds["max_inline_file_size"] = args.max_inline_file_size
+    if args.disable_pass:
+        names = Optimizer.pass_names()
+        for name in args.disable_pass:
+            if name not in names:
+                fatal(localize("cli.getconfig.unknownpass") % name)
+        kwds["disabled_passes"] = tuple(args.disable_pass)
+    if args.call_profile:
+        kwds["call_profile"] = read_call_profile(args.call_profile,
+                                                 args.encoding)
     if args.init_file:
         kwds["split_init"] = True
         if args.init_file is not _NOTGIVEN:
@@ -164,58 +225,269 @@ def get_config(args) -> Config:
         kwds["internal_folder"] = args.internal_folder
     return Config(**kwds)
 
-def try_rmtree(path: str):
+def read_call_profile(path: str, encoding: Optional[str]) \
+        -> Tuple[Tuple[str, int], ...]:
+    """
+    Read a profile of mcfunctions: a JSON object that maps paths of
+    mcfunctions (as used in /function) to how many times they were run.
+    """
+    try:
+        with open(path, "r", encoding=encoding) as file:
+            data = json.load(file)
+    except (OSError, ValueError) as err:
+        fatal(localize("cli.getconfig.invalidprofile")
+              .format(path=path, msg=err))
+    if not (isinstance(data, dict) and all(
+        type(count) is int and count >= 0 for count in data.values()
+    )):
+        fatal(localize("cli.getconfig.invalidprofile").format(
+            path=path, msg=localize("cli.getconfig.profileformat")
+        ))
+    return tuple(sorted(data.items()))
+
+def get_cache(args) -> Optional[CompileCache]:
     """
-    Delete `path` if this path exists.
-    Report any error as `fatal`.
+    Create the `CompileCache` requested by `args`. When no cache
+    directory is requested, the cache only lives in memory if multiple
+    files are compiled, and no cache is used otherwise.
     """
-    if os.path.exists(path):
+    if not args.cache:
+        if len(args.file) > 1:
+            return CompileCache()
+        return None
+    if args.cache is _NOTGIVEN:
+        main_dir = os.path.commonpath([
+            os.path.dirname(os.path.realpath(file)) for file in args.file
+        ])
+        return CompileCache(os.path.join(main_dir, CACHE_DIR_NAME))
+    return CompileCache(os.path.realpath(args.cache))
+
+def get_out_paths(args) -> List[Tuple[str, str]]:
+    """Return (source file, output path) for every file to compile."""
+    ext = '.mcpack' if args.archive else '.acaout'
+    if len(args.file) == 1 and args.out:
+        return [(args.file[0], os.path.realpath(args.out))]
+    res = []
+    for file in args.file:
+        # default out path: ./<name of source>.acaout, or
+        # ./<name of source>.mcpack for archives
+        out_path, _ = os.path.splitext(file)
+        if args.out:
+            # Compiling multiple files: --out is a directory
+            out_path = os.path.join(args.out, os.path.basename(out_path))
+        res.append((file, os.path.realpath(out_path) + ext))
+    return res
+
+def write_output(args, compiler: Compiler, cfg: Config,
+                 out_path: str) -> OutputStats:
+    """Write output of `compiler` to `out_path`."""
+    if args.archive:
+        if args.pack_manifest is None:
+            manifest = None
+        else:
+            manifest = pack_manifest(
+                args.pack_manifest, localize("cli.build.packdescription"),
+                cfg.mc_version
+            )
+        stats = compiler.output_archive(out_path, manifest,
+                                        workers=args.output_workers)
+    else:
+        # Old files are only removed (-u) if compilation succeeded.
+        stats = compiler.output(out_path, prune=args.override_old,
+                                workers=args.output_workers)
+    return stats
+
+def build(args, file: str, cfg: Config, cache: Optional[CompileCache],
+          out_path: str) -> Tuple[Compiler, OutputStats]:
+    """Compile `file` and write output to `out_path`."""
+    compiler = Compiler(file, cfg, cache)
+    if args.stats:
+        print_stats(file, compiler)
+    return compiler, write_output(args, compiler, cfg, out_path)
+
+def print_stats(file: str, compiler: Compiler):
+    """Print statistics of optimizer."""
+    if compiler.from_cache:
+        print(localize("cli.stats.cached").format(file=file))
+        return
+    mgr = compiler.output_mgr
+    if isinstance(mgr, Optimizer) and mgr.slot_stats is not None:
+        before, after = mgr.slot_stats
+        print(localize("cli.stats.slots").format(
+            file=file, before=before, after=after
+        ))
+    if isinstance(mgr, Optimizer) and mgr.pass_stats is not None:
+        for name, stats in mgr.pass_stats.items():
+            print(localize("cli.stats.pass").format(
+                file=file, name=name, runs=stats.runs,
+                time=stats.time * 1000, commands=stats.commands_removed,
+                files=stats.files_removed
+            ))
+    if isinstance(mgr, Optimizer) and mgr.call_depth_stats is not None:
+        depth, recursive = mgr.call_depth_stats
+        if recursive is None:
+            print(localize("cli.stats.calldepth").format(
+                file=file, depth=depth
+            ))
+        else:
+            print(localize("cli.stats.calldepthrecursive").format(
+                file=file, depth=depth, function=recursive
+            ))
+
+def _build_in_worker(args, file: str, cfg: Config, cache_dir: Optional[str],
+                     out_path: str) -> Optional[str]:
+    """
+    Build `file` in a worker process of `build_batch`. Return the error
+    message if it failed.
+    """
+    global _worker_cache
+    if _worker_cache is None:
+        # Kept for later entries that are given to this process
+        _worker_cache = CompileCache(cache_dir)
+    try:
+        build(args, file, cfg, _worker_cache, out_path)
+    except Exception as err:
+        return describe_error(err, args.verbose)
+    return None
+
+def build_batch(args, entries: List[Tuple[str, str]], cfg: Config,
+                cache: Optional[CompileCache]) -> bool:
+    """
+    Compile every (source file, output path) in `entries`, sharing
+    loaded modules between them. Errors are reported without stopping
+    other entries. Return if all entries succeeded.
+    When `args.jobs` > 1, entries are distributed to that many
+    processes, each of which has its own copy of `cache`.
+    """
+    ok = True
+    if args.jobs > 1:
+        jobs = min(args.jobs, len(entries))
+        with ProcessPoolExecutor(jobs) as pool:
+            futures = [
+                pool.submit(_build_in_worker, args, file, cfg,
+                            cache and cache.directory, out_path)
+                for file, out_path in entries
+            ]
+            # Report in order of `entries`
+            for future in futures:
+                msg = future.result()
+                if msg is not None:
+                    error(msg)
+                    ok = False
+        return ok
+    if cache is None:
+        # Share loaded modules between entries anyway
+        cache = CompileCache()
+    for file, out_path in entries:
         try:
-            shutil.rmtree(path)
-        except OSError as e:
-            fatal(localize("cli.tryrmtree.failure")
-                  .format(path=path, message=e.strerror))
+            build(args, file, cfg, cache, out_path)
+        except Exception as err:
+            error(describe_error(err, args.verbose))
+            ok = False
+    return ok
 
-def run(args):
-    if not os.path.exists(args.file):
-        fatal('file not found: %s' % args.file)
-    if not os.path.isfile(args.file):
-        fatal('not a file: %s' % args.file)
+def describe_error(err: Exception, verbose: bool) -> str:
+    """Get the message to report an error raised by `build`."""
+    if isinstance(err, CompileError):
+        return err.full_msg()
+    import traceback
+    if verbose:
+        traceback.print_exc()
+        print(file=sys.stderr)
+        return localize("cli.run.aboveunexpectederror")
+    return (
+        localize("cli.run.unexpectederror")
+        % traceback.format_exception_only(type(err), err)[-1].strip()
+    )
 
-    if args.out:
-        out_path = os.path.realpath(args.out)
-    else:  # default out path: ./<name of source>.acaout
-        out_path, _ = os.path.splitext(args.file)
-        out_path = os.path.realpath(out_path) + '.acaout'
+def _mtimes(paths: Iterable[str]) -> Dict[str, Optional[int]]:
+    res = {}
+    for path in paths:
+        try:
+            res[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            res[path] = None
+    return res
 
+def watch(args, file: str, cfg: Config, cache: Optional[CompileCache],
+          out_path: str):
+    """
+    Build again whenever the main file or any module it uses changes,
+    until interrupted. Compilation errors are reported without exiting.
+    """
+    watched = {os.path.realpath(file)}
+    try:
+        while True:
+            try:
+                compiler, stats = build(args, file, cfg, cache, out_path)
+            except Exception as err:
+                error(describe_error(err, args.verbose))
+                # Keep watching what we watched and where the error is
+                if isinstance(err, CompileError) and err.location.file_set():
+                    watched.add(os.path.realpath(err.location.file))
+            else:
+                print(localize("cli.watch.success").format(
+                    path=out_path, written=stats.written,
+                    unchanged=stats.unchanged, removed=stats.removed
+                ))
+                watched = set(compiler.dependencies)
+                watched.add(os.path.realpath(file))
+            print(localize("cli.watch.waiting") % len(watched))
+            mtimes = _mtimes(watched)
+            while _mtimes(watched) == mtimes:
+                time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+
+def run(args):
+    for file in args.file:
+        if not os.path.exists(file):
+            fatal('file not found: %s' % file)
+        if not os.path.isfile(file):
+            fatal('not a file: %s' % file)
+
+    entries = get_out_paths(args)
     cfg = get_config(args)
+    if args.output_workers < 1:
+        fatal(localize("cli.run.outputworkerstoolow") % args.output_workers)
+    if args.jobs < 1:
+        fatal(localize("cli.run.jobstoolow") % args.jobs)
+    if args.pack_manifest is not None and not args.archive:
+        fatal(localize("cli.run.manifestwithoutarchive"))
+    if args.watch and len(entries) > 1:
+        fatal(localize("cli.run.watchmultiple"))
+    out_paths = set()
+    for file, out_path in entries:
+        if out_path in out_paths:
+            fatal(localize("cli.run.duplicateoutput") % out_path)
+        out_paths.add(out_path)
 
-    if not os.path.exists(out_path):
-        out_up = os.path.dirname(out_path)
+    if len(entries) > 1 and args.out and not os.path.exists(args.out):
+        out_up = os.path.dirname(os.path.realpath(args.out))
         if not os.path.exists(out_up):
             fatal(localize("cli.run.outputnotfound") % out_up)
-        os.mkdir(out_path)
+        os.mkdir(args.out)
+    for _, out_path in entries:
+        if not os.path.exists(out_path):
+            out_up = os.path.dirname(out_path)
+            if not os.path.exists(out_up):
+                fatal(localize("cli.run.outputnotfound") % out_up)
+            if not args.archive:
+                os.mkdir(out_path)
 
+    cache = get_cache(args)
+    if args.watch:
+        file, out_path = entries[0]
+        watch(args, file, cfg, cache, out_path)
+        return
     try:
-        compiler = Compiler(args.file, cfg)
-        if args.override_old:
-            # Remove old output directory if -u is set and compilation
-            # succeeded.
-            try_rmtree(os.path.join(out_path, cfg.root_folder))
-        compiler.output(out_path)
-    except CompileError as err:
-        fatal(err.full_msg())
+        if len(entries) == 1:
+            file, out_path = entries[0]
+            build(args, file, cfg, cache, out_path)
+        elif not build_batch(args, entries, cfg, cache):
+            sys.exit(1)
     except Exception as err:
-        import traceback
-        if args.verbose:
-            traceback.print_exc()
-            print(file=sys.stderr)
-            fatal(localize("cli.run.aboveunexpectederror"))
-        else:
-            fatal(
-                localize("cli.run.unexpectederror")
-                % traceback.format_exception_only(err)[-1].strip()
-            )
+        fatal(describe_error(err, args.verbose))
 
 def main():
     argparser = build_argparser()
@@ -3,21 +3,31 @@ The main compiler of Acacia.
 It assembles files and classes together and writes output.
 """
 
-__all__ = ['Compiler', 'Config']
+__all__ = ['Compiler', 'Config', 'OutputStats', 'pack_manifest']
 
 from typing import (
-    Tuple, Union, Optional, Callable, Dict, NamedTuple, List, TYPE_CHECKING
+    Tuple, Union, Optional, Callable, Dict, NamedTuple, List, Iterable,
+    Iterator, TypeVar, Set, TYPE_CHECKING
 )
+import io
+import json
 import os
+import tempfile
+import uuid
+import zipfile
+from collections import deque
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-from acaciamc.ast import ModuleMeta
+from acaciamc.ast import ModuleMeta, Module
 from acaciamc.error import *
+from acaciamc.cache import CompileCache, BuildRecord, file_digest
 from acaciamc.tokenizer import Tokenizer
 from acaciamc.parser import Parser
 from acaciamc.mccmdgen.generator import Generator
 from acaciamc.mccmdgen.expr import *
 from acaciamc.mccmdgen.optimizer import Optimizer
+from acaciamc.mccmdgen.dataflow import format_range
 from acaciamc.mccmdgen.utils import unreachable
 from acaciamc.objects import (
     IntVar, BinaryModule, EntityTemplate, DEFAULT_ENTITY_NEW
@@ -27,6 +37,9 @@ import acaciamc.mccmdgen.cmds as cmds
 if TYPE_CHECKING:
     from acaciamc.tools.versionlib import VERSION_T
 
+_T = TypeVar("_T")
+_R = TypeVar("_R")
+
 class OutputManager(cmds.FunctionsManager):
     def __init__(self, cfg: "Config"):
         super().__init__(cfg.scoreboard)
@@ -49,7 +62,20 @@ class OutputManager(cmds.FunctionsManager):
         fname = f"{self._cfg.internal_folder}/acalib{self._lib_count}"
         self.new_file(file, fname)
 
+    def mark_dispatcher(self, file: cmds.MCFunctionFile):
+        """Mark `file` as one that runs one of several commands
+        depending on conditions.
+        """
+        pass
+
 class OutputOptimized(OutputManager, Optimizer):
+    def __init__(self, cfg: "Config"):
+        super().__init__(cfg)
+        self._dispatchers: Set[cmds.MCFunctionFile] = set()
+
+    def mark_dispatcher(self, file: cmds.MCFunctionFile):
+        self._dispatchers.add(file)
+
     def entry_files(self):
         internal = self.mcfunction_path(self._cfg.internal_folder) + "/"
         for file in self.files:
@@ -64,10 +90,22 @@ class OutputOptimized(OutputManager, Optimizer):
     def max_inline_file_size(self) -> int:
         return self._cfg.max_inline_file_size
 
+    @property
+    def call_profile(self) -> Optional[Dict[str, int]]:
+        if self._cfg.call_profile is None:
+            return None
+        return dict(self._cfg.call_profile)
+
+    @property
+    def disabled_passes(self) -> Iterable[str]:
+        return self._cfg.disabled_passes
+
     def dont_inline_execute_call(self, file: cmds.MCFunctionFile) -> bool:
         # Expanding /execute function calls in tick.mcfunction can
-        # decrease performance badly.
-        return file.get_path() == self.tick_file_full_path
+        # decrease performance badly; so can expanding those in or to
+        # dispatchers, where only one of the calls runs.
+        return (file.get_path() == self.tick_file_full_path
+                or file in self._dispatchers)
 
 class Config(NamedTuple):
     # Generate debug comments in .mcfunction files
@@ -99,6 +137,12 @@ class Config(NamedTuple):
     # even if it is called with /execute condition (ignored if optimizer
     # is False)
     max_inline_file_size: int = 20
+    # How many times each mcfunction (given by path used in /function)
+    # was run in a profile, as (path, count) pairs; used to guide
+    # optimizer (ignored if optimizer is False)
+    call_profile: Optional[Tuple[Tuple[str, int], ...]] = None
+    # Names of optimizer passes not to run (see `Optimizer.pass_names`)
+    disabled_passes: Tuple[str, ...] = ()
     # Encoding of input and output files
     encoding: Optional[str] = None
 
@@ -113,15 +157,82 @@ class CachedModule(NamedTuple):
     # (None if `main` is None)
     loaded_var: Optional[cmds.ScbSlot] = None
 
+def _map_in_pool(func: Callable[[_T], _R], items: Iterable[_T],
+                 workers: int) -> List[_R]:
+    """
+    Return `list(map(func, items))`, using a pool of `workers` threads
+    when `workers` > 1. Results keep the order of `items`; if `func`
+    raises, the exception of the first failed item is re-raised.
+    """
+    if workers <= 1:
+        return list(map(func, items))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items))
+
+def _imap_in_pool(func: Callable[[_T], _R], items: Iterable[_T],
+                  workers: int) -> Iterator[_R]:
+    """
+    Lazy version of `_map_in_pool`: yield `func(item)` for `items` in
+    order, keeping at most 2 * `workers` of them in flight so that
+    results are not held longer than the consumer needs them.
+    """
+    if workers <= 1:
+        yield from map(func, items)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def pack_manifest(name: str, description: str,
+                  mc_version: "VERSION_T") -> str:
+    """
+    Return content of manifest.json of a behavior pack named `name`.
+    UUIDs are derived from `name` so that rebuilding a pack produces
+    the same manifest.
+    """
+    def _uuid(kind: str) -> str:
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f"acacia:{kind}:{name}"))
+    version = [1, 0, 0]
+    manifest = {
+        "format_version": 2,
+        "header": {
+            "name": name,
+            "description": description,
+            "uuid": _uuid("header"),
+            "version": version,
+            "min_engine_version": list(mc_version[:3]),
+        },
+        "modules": [
+            {"type": "data", "uuid": _uuid("data"), "version": version}
+        ]
+    }
+    return json.dumps(manifest, indent=4)
+
+class OutputStats(NamedTuple):
+    # Number of files written
+    written: int = 0
+    # Number of files that already had the right content
+    unchanged: int = 0
+    # Number of stale files removed
+    removed: int = 0
+
 class Compiler:
     """Start compiling the project
     A Compiler manage the resources in the compile task and
     connect the steps to compile: Tokenizer -> Parser -> Generator.
     """
-    def __init__(self, main_path: str, cfg: Optional[Config] = None):
+    def __init__(self, main_path: str, cfg: Optional[Config] = None,
+                 cache: Optional[CompileCache] = None):
         """
         main_path: path of main source file
         cfg: optional `Config` object
+        cache: optional `CompileCache` to reuse results of previous
+          compilations from
         """
         self.main_dir, _ = os.path.split(main_path)
         self.main_dir = os.path.realpath(self.main_dir)
@@ -150,7 +261,56 @@ class Compiler:
         self._before_finish_cbs = []  # callbacks to run before finish
         self._entity_template_id_max = 0  # max id of entity template
         self.etemplate_id_scb = self.add_scoreboard()
+        self.cache = cache
+        # path -> digest of files that this compilation depends on
+        self.dependencies: Dict[str, Optional[str]] = {}
+        self._module_lookups: Dict[Tuple[int, Tuple[str, ...], str], str] \
+            = {}
+        self._rendered: Optional[Dict[str, str]] = None  # see `render`
+        # Whether the result is taken from `cache` without compiling
+        self.from_cache = False
+
+        if cache is not None:
+            build_key = cache.build_key(main_path, self.cfg)
+            record = cache.load_build(build_key)
+            if record is not None and self._is_up_to_date(record):
+                # Nothing has changed since last compilation
+                self.dependencies.update(record.dependencies)
+                self._rendered = record.files
+                self.from_cache = True
+                return
+        self._compile(main_path)
+        if cache is not None:
+            cache.store_build(build_key, BuildRecord(
+                dependencies=list(self.dependencies.items()),
+                imports=list(self._module_lookups.items()),
+                files=self.render()
+            ))
+
+    @classmethod
+    def batch(cls, main_paths: Iterable[str], cfg: Optional[Config] = None,
+              cache: Optional[CompileCache] = None
+              ) -> Iterator[Tuple[str, Union["Compiler", Error]]]:
+        """
+        Compile independent entry files `main_paths` one by one and
+        yield (main path, `Compiler`) for each of them, or
+        (main path, `Error`) if the entry failed to compile.
+        Parse trees of modules and binary modules are loaded only once
+        and shared by all the entries through `cache` (a `CompileCache`
+        that only lives in memory is used if not given), while output
+        of every entry is still kept in its own `Compiler`.
+        """
+        if cache is None:
+            cache = CompileCache()
+        for main_path in main_paths:
+            try:
+                compiler = cls(main_path, cfg, cache)
+            except Error as err:
+                yield main_path, err
+            else:
+                yield main_path, compiler
 
+    def _compile(self, main_path: str):
         # --- BUILTINS ---
         self.base_template = EntityTemplate(
             name="Entity",
@@ -212,21 +372,102 @@ class Compiler:
         if isinstance(self.output_mgr, OutputOptimized):
             self.output_mgr.optimize()
 
-    def output(self, path: str):
+    def render(self, workers: int = 1) -> Dict[str, str]:
+        """
+        Return content of output files, mapped from their paths
+        relative to output directory (see `output`).
+        `workers` is the number of threads used to render mcfunctions.
+        """
+        if self._rendered is None:
+            self._rendered = dict(self.iter_rendered(workers))
+        return self._rendered
+
+    def iter_rendered(self, workers: int = 1) -> Iterator[Tuple[str, str]]:
+        """
+        Yield the items of `render` one by one as they are rendered,
+        without keeping all of them in memory (unless `render` has
+        already been called).
+        """
+        if self._rendered is not None:
+            yield from self._rendered.items()
+            return
+        files = self.output_mgr.files
+        contents = _imap_in_pool(
+            lambda file: file.to_str(debugging=self.cfg.debug_comments),
+            files, workers
+        )
+        for file, content in zip(files, contents):
+            yield file.get_path() + '.mcfunction', content
+        # tick.json
+        if self.file_tick.has_content():
+            yield ('tick.json',
+                   '{"values": ["%s"]}' % self.output_mgr.tick_file_full_path)
+
+    def output(self, path: str, prune: bool = False,
+               workers: int = 1) -> OutputStats:
         """
         Output result to `path`.
         e.g. when `path` is "a/b", main file is generated at
         "a/b/{self.cfg.root_folder}/main.mcfunction".
+        Files that already have the right content are left untouched.
+        If `prune` is True, other files in the function folder
+        ("a/b/{self.cfg.root_folder}" in the example) are removed.
+        `workers` is the number of threads used to render and write
+        files. The result does not depend on it, and if writing several
+        files fails, the error of the first one (in the order of
+        `render`) is raised.
         """
-        # Mcfunctions
-        for file in self.output_mgr.files:
-            self._write_mcfunction(file, path)
-        # tick.json
-        if self.file_tick.has_content():
-            self._write_file(
-                '{"values": ["%s"]}' % self.output_mgr.tick_file_full_path,
-                os.path.join(path, 'tick.json')
-            )
+        files = self.render(workers)
+        written = _map_in_pool(
+            lambda item: self._write_file(
+                content=item[1], path=os.path.join(path, item[0])
+            ),
+            files.items(), workers
+        ).count(True)
+        removed = self._prune_output(path, files) if prune else 0
+        return OutputStats(written, len(files) - written, removed)
+
+    def output_archive(self, path: str, manifest: Optional[str] = None,
+                       workers: int = 1) -> OutputStats:
+        """
+        Output result into a zip archive (e.g. a .mcpack) at `path`.
+        The archive is laid out as a behavior pack: files that `output`
+        would generate go into "functions/". When `manifest` is given,
+        it is written as "manifest.json" (see `pack_manifest`).
+        Files are compressed one by one as they are rendered (see
+        `iter_rendered`), and `path` is only replaced once the archive
+        is complete.
+        """
+        encoding = self.cfg.encoding or "utf-8"
+        def _add(zf: zipfile.ZipFile, name: str, content: str):
+            # Fixed timestamp makes the archive reproducible.
+            info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zf.writestr(info, content.encode(encoding))
+        folder = os.path.dirname(os.path.realpath(path))
+        try:
+            fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f, \
+                     zipfile.ZipFile(f, "w") as zf:
+                    if manifest is not None:
+                        _add(zf, "manifest.json", manifest)
+                    count = 0
+                    for rel_path, content in self.iter_rendered(workers):
+                        _add(zf, "functions/" + rel_path, content)
+                        count += 1
+                # `mkstemp` makes the file private; give it the mode
+                # `open` would have given it.
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmp, 0o666 & ~umask)
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        except OSError as err:
+            self.raise_error(Error(ErrorType.IO, message=str(err)))
+        return OutputStats(written=count)
 
     def raise_error(self, error: Error):
         if self.current_generator is not None:
@@ -245,6 +486,47 @@ class Compiler:
         else:
             self.output_mgr.new_file(file, path)
 
+    def mark_dispatcher(self, file: cmds.MCFunctionFile):
+        """
+        Mark `file` as one that runs one of several commands depending
+        on conditions (e.g. a branch of a binary search), so that
+        optimizer keeps conditional calls in it as they are.
+        """
+        self.output_mgr.mark_dispatcher(file)
+
+    def range_dispatch(
+        self, slot: cmds.ScbSlot,
+        ranges: List[Tuple[int, int, cmds.Command]]
+    ) -> List[cmds.Command]:
+        """
+        Return commands that run the command of the range in `ranges`
+        (sorted and not overlapping) that value of `slot` is in.
+        Ranges are searched as a binary tree of dispatcher files so
+        that only O(log n) conditions are checked.
+        """
+        if len(ranges) <= 2:
+            halves = [[r] for r in ranges]
+        else:
+            mid = len(ranges) // 2
+            halves = [ranges[:mid], ranges[mid:]]
+        res = []
+        for half in halves:
+            match = format_range(half[0][0], half[-1][1])
+            if len(half) == 1:
+                runs = half[0][2]
+            else:
+                sub = cmds.MCFunctionFile()
+                self.add_file(sub)
+                self.mark_dispatcher(sub)
+                sub.write_debug("## Dispatcher for %s in %s"
+                                % (slot.to_str(), match))
+                sub.extend(self.range_dispatch(slot, half))
+                runs = cmds.InvokeFunction(sub)
+            res.append(cmds.Execute(
+                [cmds.ExecuteScoreMatch(slot, match)], runs=runs
+            ))
+        return res
+
     # -- About allocation --
 
     def allocate(self) -> cmds.ScbSlot:
@@ -301,6 +583,29 @@ class Compiler:
         """Add a callback before compilation finishes."""
         self._before_finish_cbs.append(callback)
 
+    def add_dependency(self, path: str):
+        """
+        Record that the output depends on content of file `path`.
+        Acacia sources and binary modules are recorded automatically;
+        binary modules that read other files (like MIDI files read by
+        `music`) should call this so that `CompileCache` notices when
+        the file changes.
+        """
+        path = os.path.realpath(path)
+        if path not in self.dependencies:
+            self.dependencies[path] = file_digest(path)
+
+    def _is_up_to_date(self, record: BuildRecord) -> bool:
+        """Return if result of `record` is still valid."""
+        for path, digest in record.dependencies:
+            if digest is None or file_digest(path) != digest:
+                return False
+        for (leading_dots, parents, last_name), path in record.imports:
+            meta = ModuleMeta(last_name, leading_dots, parents)
+            if self.find_module(meta) != path:
+                return False
+        return True
+
     def find_module(self, meta: ModuleMeta) -> Union[str, None]:
         """Find a module.
         Return path of module or None is not found
@@ -350,6 +655,9 @@ class Compiler:
             self.raise_error(
                 Error(ErrorType.MODULE_NOT_FOUND, module=str(meta))
             )
+        self._module_lookups[
+            (meta.leading_dots, tuple(meta.parents), meta.last_name)
+        ] = path
         # Get the module accoding to path
         for cm in self._cached_modules:
             # Return cached if exists
@@ -366,8 +674,18 @@ class Compiler:
                     mod = generator.parse_as_module()
             elif ext == ".py":
                 # Parse the binary module
-                mod = BinaryModule(path)
+                self.add_dependency(path)
+                key = os.path.realpath(path)
+                digest = self.dependencies[key]
+                py_module = None
+                if self.cache is not None:
+                    # Reuse Python code executed by another compilation
+                    py_module = self.cache.load_binary_module(key, digest)
+                mod = BinaryModule(path, py_module)
                 mod_main.extend(mod.execute(self))
+                if self.cache is not None:
+                    self.cache.store_binary_module(key, digest,
+                                                   mod.py_module)
             else:
                 unreachable()
             if mod_main.has_content():
@@ -428,28 +746,50 @@ class Compiler:
         for p in self._loading_files:
             if os.path.samefile(p, path):
                 self.raise_error(Error(ErrorType.CIRCULAR_PARSE, file_=path))
+        self.add_dependency(path)
         src_file = self._open_file(path)
         oldf = self._current_file
         oldg = self.current_generator
         self._current_file = path
         self._loading_files.append(path)
-        try:
-            node = Parser(Tokenizer(src_file, self.cfg.mc_version)).module()
-        except Error as err:
-            if not err.location.file_set():
-                err.location.file = path
-            raise
-        finally:
-            src_file.close()
-        self.current_generator = Generator(
-            node=node, main_file=mcfunc,
-            file_name=path, compiler=self
-        )
-        yield self.current_generator
+        # The source is kept open while generating, since statements
+        # might be parsed on demand (see `_parse`).
+        with src_file:
+            try:
+                node = self._parse(src_file)
+            except Error as err:
+                if not err.location.file_set():
+                    err.location.file = path
+                raise
+            self.current_generator = Generator(
+                node=node, main_file=mcfunc,
+                file_name=path, compiler=self
+            )
+            yield self.current_generator
         self._current_file = oldf
         self.current_generator = oldg
         self._loading_files.pop()
 
+    def _parse(self, src_file) -> Module:
+        """Parse an opened source file, using the cache if possible."""
+        if self.cache is None:
+            # Without a cache the tree does not have to be kept, so
+            # statements are parsed as the generator asks for them,
+            # and only one top-level statement needs to be in memory
+            # at a time.
+            return Parser(
+                Tokenizer(src_file, self.cfg.mc_version)
+            ).module_stream()
+        src = src_file.read()
+        key = self.cache.ast_key(src, self.cfg.mc_version)
+        node = self.cache.load_ast(key)
+        if node is None:
+            node = Parser(
+                Tokenizer(io.StringIO(src), self.cfg.mc_version)
+            ).module()
+            self.cache.store_ast(key, node)
+        return node
+
     # --- I/O Util (Internal use) ---
 
     def _open_file(self, path: str):
@@ -469,21 +809,46 @@ class Compiler:
         else:
             return s
 
-    def _write_file(self, content: str, path: str):
-        """Write `content` to `path`."""
+    def _write_file(self, content: str, path: str) -> bool:
+        """
+        Write `content` to `path`, unless it already has it.
+        Return whether the file is written.
+        """
+        try:
+            with open(path, 'r', encoding=self.cfg.encoding) as f:
+                if f.read() == content:
+                    # Leave identical file (and its mtime) untouched
+                    return False
+        except (OSError, ValueError):
+            pass
         os.makedirs(os.path.dirname(path), exist_ok=True)
         try:
             with open(path, 'w', encoding=self.cfg.encoding) as f:
                 f.write(content)
         except Exception as err:
             self.raise_error(Error(ErrorType.IO, message=str(err)))
+        return True
 
-    def _write_mcfunction(self, file: cmds.MCFunctionFile, path: str):
-        """Write content of `file` to somewhere in output `path`
-        e.g. when `path` is "a/b", `file.path` is "a", file is at
-        "a/b/a.mcfunction".
+    def _prune_output(self, path: str, files: Dict[str, str]) -> int:
         """
-        self._write_file(
-            content=file.to_str(debugging=self.cfg.debug_comments),
-            path=os.path.join(path, file.get_path() + '.mcfunction')
-        )
+        Remove files in function folder under output `path` that are not
+        in `files` (see `render`), along with emptied directories.
+        Return number of removed files.
+        """
+        def _key(p: str) -> str:
+            return os.path.normcase(os.path.normpath(p))
+        keep = {_key(os.path.join(path, rel_path)) for rel_path in files}
+        root = os.path.join(path, self.cfg.root_folder)
+        removed = 0
+        try:
+            for dirpath, _, filenames in os.walk(root, topdown=False):
+                for name in filenames:
+                    file_path = os.path.join(dirpath, name)
+                    if _key(file_path) not in keep:
+                        os.remove(file_path)
+                        removed += 1
+                if _key(dirpath) != _key(root) and not os.listdir(dirpath):
+                    os.rmdir(dirpath)
+        except OSError as err:
+            self.raise_error(Error(ErrorType.IO, message=str(err)))
+        return removed
@@ -2,7 +2,9 @@
 
 from abc import ABCMeta, abstractmethod
 from enum import Enum
-from typing import List, NamedTuple, Optional, Union, Iterable, Callable, Dict
+from typing import (
+    List, NamedTuple, Optional, Union, Iterable, Callable, Dict, Set
+)
 import json
 
 from acaciamc.constants import TERMINATOR_CHARS
@@ -584,6 +586,8 @@ class FunctionsManager:
         self.scoreboard = scoreboard
         self.files: List["MCFunctionFile"] = []
         self._alloc_id = 0
+        # Slots handed out by `allocate`, which nothing else may use
+        self.allocated: Set[ScbSlot] = set()
         self._int_consts: Dict[int, ScbSlot] = {}
         self._scb_id = 0
         self._extra_obj = self.EXTRA_OBJ % scoreboard
@@ -608,7 +612,9 @@ class FunctionsManager:
 
     def allocate(self) -> ScbSlot:
         self._alloc_id += 1
-        return ScbSlot("acacia%d" % self._alloc_id, self.default_scb)
+        slot = ScbSlot("acacia%d" % self._alloc_id, self.default_scb)
+        self.allocated.add(slot)
+        return slot
 
     def add_file(self, file: "MCFunctionFile"):
         self.files.append(file)
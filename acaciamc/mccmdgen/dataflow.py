@@ -0,0 +1,590 @@
+"""Data flow analysis of scoreboard slots for the optimizer.
+
+Only slots handed out by `FunctionsManager.allocate` are analyzed;
+other slots (like those from `scb(...)` in user code) are visible to
+players, so their values must be left as they are. Allocated slots
+that are mentioned by raw commands can be accessed in ways we can't
+see, so they are excluded as well.
+Sets of slots are represented as bit masks (`int`s).
+"""
+
+__all__ = ["SlotAccess", "Liveness", "CallGraph", "SlotAnalysis",
+           "written_slots", "ConstState", "ConstPropagation",
+           "eval_condition", "parse_range", "format_range"]
+
+from typing import (
+    Container, Dict, Iterable, List, NamedTuple, Optional, Set, Callable,
+    Tuple
+)
+import re
+
+from acaciamc.constants import INT_MIN, INT_MAX
+from acaciamc.objects.integer import c_int_div, remainder
+import acaciamc.mccmdgen.cmds as cmds
+
+_TOKEN = re.compile(r'"(?:\\.|[^"\\])*"|[^\s"]+')
+
+class SlotAccess(NamedTuple):
+    # Slots that may be read
+    reads: int
+    # Slots that may be written
+    writes: int
+    # Slots that are always overwritten without being read first
+    kills: int
+    # mcfunction called by this command immediately
+    callee: Optional[cmds.MCFunctionFile] = None
+
+NO_ACCESS = SlotAccess(0, 0, 0)
+
+class Liveness(NamedTuple):
+    # Slots that are live when entering each function
+    live_in: Dict[cmds.MCFunctionFile, int]
+    # Slots that are live when each function returns
+    live_out: Dict[cmds.MCFunctionFile, int]
+
+def written_slots(command: cmds.Command) -> Optional[List[cmds.ScbSlot]]:
+    """Return the slots written by a scoreboard command that has no
+    other side effects. Return None for other commands.
+    """
+    if isinstance(command, (cmds.ScbSetConst, cmds.ScbAddConst,
+                            cmds.ScbRemoveConst, cmds.ScbRandom)):
+        return [command.target]
+    if isinstance(command, cmds.ScbOperation):
+        if command.operator is cmds.ScbOp.SWAP:
+            return [command.operand1, command.operand2]
+        return [command.operand1]
+    return None
+
+class CallGraph:
+    """Index of function calls among a group of mcfunctions.
+    `calls` tells which function a command calls (None if it does
+    not); by default it is every function the command refers to.
+    """
+
+    def __init__(self, files: Iterable[cmds.MCFunctionFile],
+                 calls: Optional[Callable[
+                     [cmds.Command], Optional[cmds.MCFunctionFile]
+                 ]] = None):
+        if calls is None:
+            calls = lambda command: command.func_ref()
+        # Functions called by each file (used as ordered sets)
+        self.callees: Dict[cmds.MCFunctionFile,
+                           Dict[cmds.MCFunctionFile, None]] = {}
+        # Where each function is called: (caller, index of command)
+        self.sites: Dict[cmds.MCFunctionFile,
+                         List[Tuple[cmds.MCFunctionFile, int]]] = {}
+        for file in files:
+            called = self.callees[file] = {}
+            for i, command in enumerate(file.commands):
+                callee = calls(command)
+                if callee is not None:
+                    called[callee] = None
+                    self.sites.setdefault(callee, []).append((file, i))
+
+    def reachable(self, entries: Iterable[cmds.MCFunctionFile]) \
+            -> Set[cmds.MCFunctionFile]:
+        """Return functions that can be called from `entries`
+        (including themselves).
+        """
+        res = set()
+        stack = list(entries)
+        while stack:
+            file = stack.pop()
+            if file in res:
+                continue
+            res.add(file)
+            stack.extend(self.callees.get(file, ()))
+        return res
+
+    def components(self) -> List[List[cmds.MCFunctionFile]]:
+        """Return strongly connected components (groups of functions
+        that can call each other), where callees come before callers.
+        """
+        # Tarjan's algorithm, without recursion so that long call
+        # chains don't hit recursion limit.
+        index: Dict[cmds.MCFunctionFile, int] = {}
+        low: Dict[cmds.MCFunctionFile, int] = {}
+        on_stack: Set[cmds.MCFunctionFile] = set()
+        stack: List[cmds.MCFunctionFile] = []
+        res = []
+        for root in self.callees:
+            if root in index:
+                continue
+            work = [(root, iter(self.callees[root]))]
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                file, it = work[-1]
+                for callee in it:
+                    if callee not in self.callees:
+                        continue
+                    if callee not in index:
+                        index[callee] = low[callee] = len(index)
+                        stack.append(callee)
+                        on_stack.add(callee)
+                        work.append((callee, iter(self.callees[callee])))
+                        break
+                    if callee in on_stack:
+                        low[file] = min(low[file], index[callee])
+                else:
+                    work.pop()
+                    if work:
+                        caller = work[-1][0]
+                        low[caller] = min(low[caller], low[file])
+                    if low[file] == index[file]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.remove(member)
+                            component.append(member)
+                            if member is file:
+                                break
+                        res.append(component)
+        return res
+
+    def is_recursive(self, component: List[cmds.MCFunctionFile]) -> bool:
+        """Return if functions in `component` can call themselves."""
+        return (len(component) > 1
+                or component[0] in self.callees[component[0]])
+
+class SlotAnalysis:
+    """Scoreboard slot accesses of a group of mcfunctions."""
+
+    def __init__(self, files: List[cmds.MCFunctionFile], objective: str,
+                 allocated: Container[cmds.ScbSlot]):
+        self.objective = objective
+        # When False, nothing can be analyzed safely
+        self.enabled = True
+        self._pinned: Set[str] = set()
+        self._bits: Dict[cmds.ScbSlot, int] = {}
+        # Used as an ordered set
+        self._universe: Dict[cmds.ScbSlot, None] = {}
+        self.scheduled: Set[cmds.MCFunctionFile] = set()
+        for file in files:
+            for command in file.commands:
+                self._collect(command)
+        # Number of allocated slots in use
+        self.slot_count = 0
+        for slot in self._universe:
+            if slot not in allocated:
+                continue
+            self.slot_count += 1
+            if slot.target not in self._pinned:
+                self._bits[slot] = 1 << len(self._bits)
+        self.all_slots = (1 << len(self._bits)) - 1
+        # Analyzed slots; the i-th one is represented by bit `1 << i`
+        self.slots = list(self._bits)
+        # Slots accessed by commands that we only know through
+        # `scb_did_read` and `scb_did_assign` hooks
+        self.hooked_slots = 0
+        # Results of `access`; commands are not changed once they are
+        # given to the optimizer, so they are cached by identity
+        self._accesses: Dict[cmds.Command, SlotAccess] = {}
+
+    def _collect(self, command: cmds.Command):
+        """Find slots and functions used in `command`."""
+        if isinstance(command, cmds.Execute):
+            for subcmd in command.subcmds:
+                if isinstance(subcmd, cmds.ExecuteScoreComp):
+                    self._add_slot(subcmd.operand1)
+                    self._add_slot(subcmd.operand2)
+                elif isinstance(subcmd, cmds.ExecuteScoreMatch):
+                    self._add_slot(subcmd.operand)
+                elif not isinstance(subcmd, (cmds.ExecuteEnv,
+                                             cmds.ExecuteCond)):
+                    self._pin(subcmd.resolve())
+            self._collect(command.runs)
+        elif isinstance(command, cmds.ScheduleFunction):
+            self.scheduled.add(command.file)
+        elif isinstance(command, cmds.RawtextOutput):
+            for slot in command.score_slots:
+                self._add_slot(slot)
+        elif isinstance(command, cmds.ScbOperation):
+            self._add_slot(command.operand1)
+            self._add_slot(command.operand2)
+        else:
+            slots = written_slots(command)
+            if slots is not None:
+                for slot in slots:
+                    self._add_slot(slot)
+            elif not isinstance(command, (
+                cmds.Comment, cmds.InvokeFunction, cmds.ScbObjAdd,
+                cmds.ScbObjDisplay, cmds.TitlerawTimes,
+                cmds.TitlerawResetTimes, cmds.TitlerawClear
+            )):
+                # Raw commands or unknown command types
+                self._pin(command.resolve())
+
+    def _add_slot(self, slot: cmds.ScbSlot):
+        if slot.objective == self.objective:
+            self._universe[slot] = None
+
+    def _pin(self, text: str):
+        """Exclude slots that may be mentioned in raw command `text`."""
+        tokens = set(_TOKEN.findall(text))
+        tokens.update([t[1:-1] for t in tokens if t.startswith('"')])
+        if self.objective in tokens or "scoreboard" in tokens:
+            if "*" in tokens:
+                self.enabled = False
+            self._pinned.update(tokens)
+
+    def tracked(self, slot: cmds.ScbSlot) -> bool:
+        """Return if `slot` is analyzed."""
+        return self.enabled and slot in self._bits
+
+    def mask(self, *slots: cmds.ScbSlot) -> int:
+        res = 0
+        for slot in slots:
+            res |= self._bits.get(slot, 0)
+        return res
+
+    def access(self, command: cmds.Command) -> SlotAccess:
+        """Return how `command` accesses analyzed slots."""
+        res = self._accesses.get(command)
+        if res is None:
+            res = self._accesses[command] = self._access(command)
+        return res
+
+    def _access(self, command: cmds.Command) -> SlotAccess:
+        if isinstance(command, cmds.Execute):
+            reads = 0
+            for subcmd in command.subcmds:
+                if isinstance(subcmd, cmds.ExecuteScoreComp):
+                    reads |= self.mask(subcmd.operand1, subcmd.operand2)
+                elif isinstance(subcmd, cmds.ExecuteScoreMatch):
+                    reads |= self.mask(subcmd.operand)
+                elif not isinstance(subcmd, (cmds.ExecuteEnv,
+                                             cmds.ExecuteCond)):
+                    reads |= self._hook_mask(subcmd.scb_did_read)
+            runs = self.access(command.runs)
+            # Conditions or environments may stop `runs` from running
+            # so nothing is certainly overwritten.
+            return SlotAccess(
+                reads | runs.reads, runs.writes,
+                0 if command.subcmds else runs.kills, runs.callee
+            )
+        if isinstance(command, (cmds.ScbSetConst, cmds.ScbRandom)):
+            target = self.mask(command.target)
+            return SlotAccess(0, target, target)
+        if isinstance(command, (cmds.ScbAddConst, cmds.ScbRemoveConst)):
+            target = self.mask(command.target)
+            return SlotAccess(target, target, target)
+        if isinstance(command, cmds.ScbOperation):
+            op1 = self.mask(command.operand1)
+            op2 = self.mask(command.operand2)
+            if command.operator is cmds.ScbOp.SWAP:
+                return SlotAccess(op1 | op2, op1 | op2, op1 | op2)
+            if command.operator is cmds.ScbOp.ASSIGN:
+                if command.operand1 == command.operand2:
+                    return SlotAccess(op2, 0, 0)
+                return SlotAccess(op2, op1, op1)
+            return SlotAccess(op1 | op2, op1, op1)
+        if isinstance(command, cmds.RawtextOutput):
+            return SlotAccess(self.mask(*command.score_slots), 0, 0)
+        if isinstance(command, cmds.InvokeFunction):
+            return SlotAccess(0, 0, 0, command.file)
+        if isinstance(command, (cmds.Cmd, cmds.Comment,
+                                cmds.ScheduleFunction)):
+            # Raw commands never touch analyzed slots (see `_pin`).
+            # Scheduled functions are treated as entries.
+            return NO_ACCESS
+        return SlotAccess(
+            self._hook_mask(command.scb_did_read),
+            self._hook_mask(command.scb_did_assign),
+            0, command.func_ref()
+        )
+
+    def _hook_mask(self, hook) -> int:
+        res = 0
+        for slot, bit in self._bits.items():
+            if hook(slot):
+                res |= bit
+        self.hooked_slots |= res
+        return res
+
+    def function_writes(self, files: Iterable[cmds.MCFunctionFile]) \
+            -> Dict[cmds.MCFunctionFile, int]:
+        """Return slots that calling each of `files` may write."""
+        direct: Dict[cmds.MCFunctionFile, int] = {}
+        for file in files:
+            res = 0
+            for command in file.commands:
+                res |= self.access(command).writes
+            direct[file] = res
+        graph = CallGraph(direct, lambda c: self.access(c).callee)
+        writes: Dict[cmds.MCFunctionFile, int] = {}
+        for component in graph.components():
+            res = 0
+            for file in component:
+                res |= direct[file]
+                for callee in graph.callees[file]:
+                    res |= writes.get(callee, 0)
+            for file in component:
+                writes[file] = res
+        return writes
+
+    def may_write(self, command: cmds.Command,
+                  slots: Iterable[cmds.ScbSlot],
+                  func_writes: Dict[cmds.MCFunctionFile, int]) -> bool:
+        """Return if `command` may change any of `slots`, given what
+        functions may write (see `function_writes`).
+        """
+        slots = tuple(slots)
+        if not all(map(self.tracked, slots)):
+            return True
+        access = self.access(command)
+        writes = access.writes
+        if access.callee is not None:
+            writes |= func_writes.get(access.callee, self.all_slots)
+        return bool(writes & self.mask(*slots))
+
+    def live_before(self, access: SlotAccess, live: int,
+                    live_in: Dict[cmds.MCFunctionFile, int]) -> int:
+        """Return slots that are live before a command, given its
+        `access`, the slots that are `live` after it and slots that
+        are live when entering each function (`live_in`).
+        """
+        callee = access.callee
+        if callee is None:
+            return (live & ~access.kills) | access.reads
+        if callee in live_in:
+            return live | live_in[callee] | access.reads
+        # Calling something we know nothing about
+        return self.all_slots
+
+    def liveness(self, files: List[cmds.MCFunctionFile],
+                 entries: Iterable[cmds.MCFunctionFile]) -> Liveness:
+        """Compute slots that are live when entering and returning
+        from each of `files`. `entries` are the functions that can be
+        run from outside (in any order, any times), so every slot that
+        they may read before writing is live when any of them returns.
+        """
+        accesses = {
+            file: [self.access(command) for command in file.commands]
+            for file in files
+        }
+        entries = set(entries) | self.scheduled
+        live_in = dict.fromkeys(files, 0)
+        live_out = dict.fromkeys(files, 0)
+        changed = True
+        while changed:
+            changed = False
+            global_live = 0
+            for file in entries:
+                global_live |= live_in.get(file, 0)
+            for file in entries:
+                if file in live_out and global_live & ~live_out[file]:
+                    live_out[file] |= global_live
+                    changed = True
+            for file in reversed(files):
+                live = live_out[file]
+                for access in reversed(accesses[file]):
+                    callee = access.callee
+                    if callee in live_out and live & ~live_out[callee]:
+                        live_out[callee] |= live
+                        changed = True
+                    live = self.live_before(access, live, live_in)
+                if live != live_in[file]:
+                    live_in[file] = live
+                    changed = True
+        return Liveness(live_in, live_out)
+
+# Known values of slots; slots that are not in the dict are unknown.
+ConstState = Dict[cmds.ScbSlot, int]
+
+def wrap_int(value: int) -> int:
+    """Wrap `value` into a 32-bit signed integer like scores do."""
+    return (value - INT_MIN) % 2 ** 32 + INT_MIN
+
+def fold_operation(op: cmds.ScbOp, a: int, b: int) -> Optional[int]:
+    """Return value of operand 1 after `a op b`, where `op` is not
+    SWAP. Return None if the result is unknown.
+    """
+    if op is cmds.ScbOp.ASSIGN:
+        return b
+    if op is cmds.ScbOp.ADD_EQ:
+        return wrap_int(a + b)
+    if op is cmds.ScbOp.SUB_EQ:
+        return wrap_int(a - b)
+    if op is cmds.ScbOp.MUL_EQ:
+        return wrap_int(a * b)
+    if op is cmds.ScbOp.MIN:
+        return min(a, b)
+    if op is cmds.ScbOp.MAX:
+        return max(a, b)
+    if b == 0:
+        # Division by zero fails
+        return None
+    if op is cmds.ScbOp.DIV_EQ:
+        return wrap_int(c_int_div(a, b))
+    if op is cmds.ScbOp.MOD_EQ:
+        return remainder(a, b)
+    raise ValueError(op)
+
+def parse_range(range_: str) -> Tuple[int, int]:
+    """Parse the range in /execute if score ... matches."""
+    if ".." not in range_:
+        value = int(range_)
+        return value, value
+    lo, hi = range_.split("..")
+    return (int(lo) if lo else INT_MIN), (int(hi) if hi else INT_MAX)
+
+def format_range(lo: int, hi: int) -> str:
+    """Inverse of `parse_range`."""
+    if lo == hi:
+        return str(lo)
+    return "%s..%s" % ('' if lo == INT_MIN else lo,
+                       '' if hi == INT_MAX else hi)
+
+_COMPARE = {
+    cmds.ScbCompareOp.EQ: int.__eq__,
+    cmds.ScbCompareOp.LT: int.__lt__,
+    cmds.ScbCompareOp.GT: int.__gt__,
+    cmds.ScbCompareOp.LTE: int.__le__,
+    cmds.ScbCompareOp.GTE: int.__ge__,
+}
+
+def eval_condition(subcmd: cmds._ExecuteSubcmd,
+                   state: ConstState) -> Optional[bool]:
+    """Return if an /execute score condition passes, or None if that
+    can't be known from `state` or `subcmd` is not a score condition.
+    """
+    if isinstance(subcmd, cmds.ExecuteScoreMatch):
+        value = state.get(subcmd.operand)
+        if value is None:
+            return None
+        range_, invert = subcmd.range, subcmd.invert
+        if range_.startswith("!"):
+            range_, invert = range_[1:], not invert
+        lo, hi = parse_range(range_)
+        return (lo <= value <= hi) != invert
+    if isinstance(subcmd, cmds.ExecuteScoreComp):
+        a = state.get(subcmd.operand1)
+        b = state.get(subcmd.operand2)
+        if a is None or b is None:
+            return None
+        return _COMPARE[subcmd.operator](a, b) != subcmd.invert
+    return None
+
+class ConstPropagation:
+    """Forward propagation of known slot values across functions.
+    A function starts with the values that are the same at all of its
+    call sites; entries (and scheduled functions) start with only
+    the slots in `consts`, which must hold the same value everywhere.
+    """
+
+    def __init__(self, analysis: SlotAnalysis,
+                 files: List[cmds.MCFunctionFile],
+                 entries: Iterable[cmds.MCFunctionFile],
+                 consts: ConstState):
+        self.analysis = analysis
+        self.func_writes = analysis.function_writes(files)
+        # `None` means the function is never reached
+        self.entry_states: Dict[cmds.MCFunctionFile,
+                                Optional[ConstState]] = \
+            dict.fromkeys(files, None)
+        for file in set(entries) | analysis.scheduled:
+            if file in self.entry_states:
+                self.entry_states[file] = dict(consts)
+        self._changed = True
+        while self._changed:
+            self._changed = False
+            for file in files:
+                state = self.entry_states[file]
+                if state is not None:
+                    state = dict(state)
+                    for command in file.commands:
+                        self.step(command, state, self._enter)
+
+    def _enter(self, callee: cmds.MCFunctionFile, state: ConstState):
+        if callee not in self.entry_states:
+            return
+        old = self.entry_states[callee]
+        if old is None:
+            new = dict(state)
+        else:
+            new = {slot: value for slot, value in old.items()
+                   if state.get(slot) == value}
+        if new != old:
+            self.entry_states[callee] = new
+            self._changed = True
+
+    def _forget(self, state: ConstState, writes: int):
+        for slot in tuple(state):
+            if self.analysis.mask(slot) & writes:
+                del state[slot]
+
+    def step(self, command: cmds.Command, state: ConstState,
+             on_call: Callable[[cmds.MCFunctionFile, ConstState], None]):
+        """Update `state` to what it is after running `command`.
+        `on_call` is called with the state whenever a function is
+        called.
+        """
+        tracked = self.analysis.tracked
+        if isinstance(command, cmds.Execute):
+            results = [eval_condition(subcmd, state)
+                       for subcmd in command.subcmds]
+            if False in results:
+                return
+            if all(results):
+                self.step(command.runs, state, on_call)
+                return
+            # `runs` may run any times, so only keep the values that
+            # are the same whether it runs or not.
+            after = dict(state)
+            self.step(command.runs, after, on_call)
+            for slot, value in tuple(state.items()):
+                if after.get(slot) != value:
+                    del state[slot]
+        elif isinstance(command, cmds.ScbSetConst):
+            if tracked(command.target):
+                state[command.target] = command.value
+        elif isinstance(command, (cmds.ScbAddConst, cmds.ScbRemoveConst)):
+            value = state.get(command.target)
+            if value is not None:
+                if isinstance(command, cmds.ScbAddConst):
+                    value += command.value
+                else:
+                    value -= command.value
+                state[command.target] = wrap_int(value)
+        elif isinstance(command, cmds.ScbOperation):
+            a = state.pop(command.operand1, None)
+            if command.operator is cmds.ScbOp.SWAP:
+                b = state.pop(command.operand2, None)
+                if b is not None and tracked(command.operand1):
+                    state[command.operand1] = b
+                if a is not None and tracked(command.operand2):
+                    state[command.operand2] = a
+                return
+            b = state.get(command.operand2)
+            if command.operand1 == command.operand2:
+                b = a
+            if b is None:
+                return
+            if command.operator is cmds.ScbOp.ASSIGN:
+                value = b
+            elif a is None:
+                return
+            else:
+                value = fold_operation(command.operator, a, b)
+            if value is not None and tracked(command.operand1):
+                state[command.operand1] = value
+        elif isinstance(command, cmds.ScbRandom):
+            state.pop(command.target, None)
+            if command.min == command.max and tracked(command.target):
+                state[command.target] = command.min
+        elif isinstance(command, cmds.InvokeFunction):
+            on_call(command.file, state)
+            self._forget(
+                state,
+                self.func_writes.get(command.file, self.analysis.all_slots)
+            )
+        else:
+            access = self.analysis.access(command)
+            writes = access.writes
+            if access.callee is not None:
+                on_call(access.callee, state)
+                writes |= self.func_writes.get(access.callee,
+                                               self.analysis.all_slots)
+            self._forget(state, writes)
@@ -9,7 +9,8 @@ from acaciamc.ast import *
 from acaciamc.error import *
 from acaciamc.objects import *
 from acaciamc.objects.none import ctdt_none
-from acaciamc.constants import FUNCTION_PATH_CHARS
+from acaciamc.objects.boolean import ScbMatchesCompare
+from acaciamc.constants import FUNCTION_PATH_CHARS, INT_MIN, INT_MAX
 from acaciamc.mccmdgen.expr import *
 from acaciamc.mccmdgen.symbol import SymbolTable, CTRTConversionError
 from acaciamc.mccmdgen.mcselector import MCSelector
@@ -40,6 +41,57 @@ OP2METHOD = {
     Operator.not_: 'unarynot'
 }
 
+def _int_ranges(condition: AcaciaExpr) \
+        -> Optional[Tuple[cmds.ScbSlot, List[Tuple[int, int]]]]:
+    """If `condition` only checks value of one score, return the score
+    and the ranges in which `condition` is true.
+    """
+    if (isinstance(condition, ScbMatchesCompare)
+            and not condition.dependencies):
+        value = condition.literal
+        ranges = {
+            Operator.greater: [(value + 1, INT_MAX)],
+            Operator.greater_equal: [(value, INT_MAX)],
+            Operator.less: [(INT_MIN, value - 1)],
+            Operator.less_equal: [(INT_MIN, value)],
+            Operator.equal_to: [(value, value)],
+            Operator.unequal_to: [(INT_MIN, value - 1),
+                                  (value + 1, INT_MAX)],
+        }[condition.operator]
+        return condition.slot, [(lo, hi) for lo, hi in ranges if lo <= hi]
+    if (isinstance(condition, WildBool) and not condition.subcmds
+            and not condition.dependencies
+            and len(condition.ranges) == 1):
+        slot, lo, hi = condition.ranges[0]
+        return slot, [(lo, hi)]
+    return None
+
+def _compared_name(node: Expression) -> Optional[str]:
+    """If `node` looks like it only compares one name with integer
+    literals (e.g. `a == 1`, `1 < a <= 5`, `a > 1 and a < 5`), return
+    the name. This only checks the syntax tree; see `_int_ranges`.
+    """
+    if isinstance(node, BoolOp) and node.operator is Operator.and_:
+        names = set(map(_compared_name, node.operands))
+        if len(names) == 1:
+            return names.pop()
+        return None
+    if not isinstance(node, CompareOp):
+        return None
+    names = set()
+    for operand in (node.left, *node.operands):
+        if isinstance(operand, Identifier):
+            names.add(operand.name)
+            continue
+        if (isinstance(operand, UnaryOp)
+                and operand.operator is Operator.negative):
+            operand = operand.operand
+        if not (isinstance(operand, Literal) and type(operand.value) is int):
+            return None
+    if len(names) == 1:
+        return names.pop()
+    return None
+
 class Context:
     def __init__(self, scope: SymbolTable):
         self.scope: SymbolTable = scope
@@ -88,6 +140,10 @@ class Generator(ASTVisitor):
         # current_tmp_scores: tmp scores allocated on current statement
         # see method `visit`.
         self.current_tmp_scores = []
+        # if_conditions: conditions of "elif"s that have been visited
+        # and commands they need (see `_jump_table`)
+        self.if_conditions: \
+            Dict[If, Tuple[AcaciaExpr, List[cmds.Command]]] = {}
 
     def parse(self):
         """Parse the AST and generate commands."""
@@ -366,11 +422,14 @@ class Generator(ASTVisitor):
         self.current_file.write(command)
 
     def visit_If(self, node: If):
-        # condition
-        condition: AcaciaExpr = self.visit(node.condition)
-        if not condition.data_type.matches_cls(BoolDataType):
-            self.error_c(ErrorType.WRONG_IF_CONDITION,
-                         got=str(condition.data_type))
+        if node in self.if_conditions:
+            # Condition has been visited by `_jump_table`
+            condition, dependencies = self.if_conditions.pop(node)
+            self.current_file.extend(dependencies)
+        else:
+            condition = self._if_condition(node)
+        if self._jump_table(node, condition):
+            return
         # process body
         with self.new_mcfunc_file() as body_file:
             self.write_debug('If body')
@@ -420,6 +479,109 @@ class Generator(ASTVisitor):
                 runs=cmds.InvokeFunction(else_body_file)
             ))
 
+    def _if_condition(self, node: If) -> AcaciaExpr:
+        condition: AcaciaExpr = self.visit(node.condition)
+        if not condition.data_type.matches_cls(BoolDataType):
+            self.error_c(ErrorType.WRONG_IF_CONDITION,
+                         got=str(condition.data_type))
+        return condition
+
+    def _jump_table(self, node: If, condition: AcaciaExpr) -> bool:
+        """Compile an if/elif chain that compares one integer with
+        constants into a binary search on the value, so that any
+        branch is reached in O(log n) checks. Return False if `node`
+        does not start such a chain.
+        """
+        first = _int_ranges(condition)
+        if first is None:
+            return False
+        # Only look at the syntax tree of "elif"s before the bodies are
+        # visited, since bodies may define names used by conditions.
+        name = _compared_name(node.condition)
+        if not (name is not None
+                and len(node.else_body) == 1
+                and isinstance(node.else_body[0], If)
+                and _compared_name(node.else_body[0].condition) == name):
+            return False
+        slot, ranges = first
+        # Bodies may change the value, so search on a copy of it. Like
+        # the condition of `visit_If`, it can't be a temporary score
+        # since functions called by bodies may use the same one.
+        value = self.compiler.allocate()
+        branches: List[Tuple[List[Tuple[int, int]],
+                             Optional[cmds.Command]]] = []
+        # The "elif" that does not check `slot`
+        rest: Optional[If] = None
+        last = node
+        while True:
+            with self.new_mcfunc_file() as body_file:
+                self.write_debug('If body')
+                for stmt in last.body:
+                    self.visit(stmt)
+            branches.append((ranges, cmds.InvokeFunction(body_file)
+                             if body_file.has_content() else None))
+            if not (len(last.else_body) == 1
+                    and isinstance(last.else_body[0], If)):
+                break
+            elif_node = last.else_body[0]
+            # Like `visit_If`, condition of an "elif" is visited after
+            # the bodies before it. It must not run any command, since
+            # all conditions are checked at the same time.
+            dep_file = cmds.MCFunctionFile()
+            with self.set_mcfunc_file(dep_file):
+                old_node = self.processing_node
+                self.processing_node = elif_node
+                elif_cond = self._if_condition(elif_node)
+                self.processing_node = old_node
+            elif_ranges = _int_ranges(elif_cond)
+            if (dep_file.has_content() or elif_ranges is None
+                    or elif_ranges[0] != slot):
+                self.if_conditions[elif_node] = \
+                    (elif_cond, dep_file.commands)
+                rest = elif_node
+                break
+            ranges = elif_ranges[1]
+            last = elif_node
+        with self.new_mcfunc_file() as else_body_file:
+            self.write_debug('Else branch of If')
+            if rest is not None:
+                self.visit(rest)
+            else:
+                for stmt in last.else_body:
+                    self.visit(stmt)
+        else_action = (cmds.InvokeFunction(else_body_file)
+                       if else_body_file.has_content() else None)
+        # Split all integers into ranges in which the same branch runs
+        bounds = {INT_MIN}
+        for ranges, _ in branches:
+            for lo, hi in ranges:
+                bounds.add(lo)
+                if hi < INT_MAX:
+                    bounds.add(hi + 1)
+        bounds = sorted(bounds)
+        table: List[Tuple[int, int, cmds.Command]] = []
+        for i, lo in enumerate(bounds):
+            hi = bounds[i + 1] - 1 if i + 1 < len(bounds) else INT_MAX
+            for ranges, action in branches:
+                if any(l <= lo <= h for l, h in ranges):
+                    break
+            else:
+                action = else_action
+            if action is None:
+                continue
+            if table and table[-1][2] is action and table[-1][1] == lo - 1:
+                table[-1] = (table[-1][0], hi, action)
+            else:
+                table.append((lo, hi, action))
+        if not table:
+            return True
+        self.write_debug('Jump table of %d branches' % len(branches))
+        self.current_file.write(
+            cmds.ScbOperation(cmds.ScbOp.ASSIGN, value, slot)
+        )
+        self.current_file.extend(self.compiler.range_dispatch(value, table))
+        return True
+
     def visit_While(self, node: While):
         # condition
         condition: AcaciaExpr = self.visit(node.condition)
@@ -1,20 +1,266 @@
 """Command abstraction optimizer."""
 
-__all__ = ["Optimizer"]
+__all__ = ["Optimizer", "PassStats"]
 
-from typing import Iterable, Dict, Set, List, Tuple
+from typing import (
+    Iterable, Dict, Set, List, Tuple, Callable, Optional, Union,
+    NamedTuple
+)
 from abc import ABCMeta, abstractmethod
+import operator
+import re
+import time
 
 import acaciamc.mccmdgen.cmds as cmds
+from acaciamc.constants import INT_MIN, INT_MAX
+from acaciamc.mccmdgen.dataflow import (
+    CallGraph, SlotAnalysis, ConstPropagation, ConstState, written_slots,
+    eval_condition, parse_range, format_range
+)
 from acaciamc.mccmdgen.utils import unreachable
 
+_SELECTOR = re.compile(r"@(initiator|[aeprs])\b")
+
+def _map_rawtext_slots(rawtext: cmds.Rawtext,
+                       slots: Dict[cmds.ScbSlot, cmds.ScbSlot]) \
+        -> cmds.Rawtext:
+    res = cmds.Rawtext()
+    for c in rawtext:
+        if isinstance(c, cmds.RawtextScore):
+            c = cmds.RawtextScore(slots.get(c.slot, c.slot))
+        elif (isinstance(c, cmds.RawtextTranslate)
+                and isinstance(c.args, cmds.Rawtext)):
+            c = cmds.RawtextTranslate(
+                c.value, _map_rawtext_slots(c.args, slots)
+            )
+        res.append(c)
+    return res
+
+def _ignore_call(callee: cmds.MCFunctionFile, state: ConstState):
+    pass
+
+def _conditions_pass(subcmds: List[cmds._ExecuteSubcmd],
+                     state: ConstState) -> Optional[bool]:
+    """Return if all /execute `subcmds` pass, or None if unknown."""
+    results = [eval_condition(subcmd, state) for subcmd in subcmds]
+    if False in results:
+        return False
+    if None in results:
+        return None
+    return True
+
+def _match_range(subcmd: cmds.ExecuteScoreMatch) \
+        -> Tuple[int, int, bool]:
+    """Return bounds of `subcmd` and if it is inverted."""
+    range_, invert = subcmd.range, subcmd.invert
+    if range_.startswith("!"):
+        range_, invert = range_[1:], not invert
+    lo, hi = parse_range(range_)
+    return lo, hi, invert
+
+def _merge_ranges(subcmds: List[cmds._ExecuteSubcmd]) \
+        -> Optional[List[cmds._ExecuteSubcmd]]:
+    """Intersect score ranges checked on the same slot in /execute
+    `subcmds`. Return None if the conditions can never pass.
+    """
+    res = []
+    segment: List[cmds._ExecuteSubcmd] = []
+
+    def _flush():
+        # Merge matches in `segment`, where no subcommand changes the
+        # context (so that "@s" always means the same entity)
+        matches: Dict[cmds.ScbSlot, List[cmds.ExecuteScoreMatch]] = {}
+        for subcmd in segment:
+            if isinstance(subcmd, cmds.ExecuteScoreMatch):
+                matches.setdefault(subcmd.operand, []).append(subcmd)
+        replaced = {}
+        for slot, group in matches.items():
+            ranges = [_match_range(subcmd) for subcmd in group]
+            positive = [(lo, hi) for lo, hi, invert in ranges
+                        if not invert]
+            if not positive:
+                # "unless" also passes when the score is not set, so
+                # it can't be changed to an "if"
+                continue
+            lo = max(r[0] for r in positive)
+            hi = min(r[1] for r in positive)
+            negative = [(l, h) for l, h, invert in ranges if invert]
+            changed = True
+            while changed and lo <= hi:
+                changed = False
+                for l, h in negative.copy():
+                    if h < lo or l > hi:
+                        negative.remove((l, h))
+                    elif l <= lo:
+                        lo = h + 1
+                    elif h >= hi:
+                        hi = l - 1
+                    else:
+                        continue
+                    changed = True
+            if lo > hi:
+                return False
+            for subcmd in group:
+                replaced[subcmd] = None
+            for subcmd, (l, h, invert) in zip(group, ranges):
+                if invert and (l, h) in negative:
+                    negative.remove((l, h))
+                    replaced[subcmd] = subcmd
+            # The merged range takes the place of the first "if"
+            first = next(subcmd for subcmd, (_, _, invert)
+                         in zip(group, ranges) if not invert)
+            if (lo, hi) == (INT_MIN, INT_MAX):
+                # Always true
+                pass
+            elif _match_range(first) == (lo, hi, False):
+                replaced[first] = first
+            else:
+                replaced[first] = cmds.ExecuteScoreMatch(
+                    slot, format_range(lo, hi)
+                )
+        for subcmd in segment:
+            new = replaced.get(subcmd, subcmd)
+            if new is not None:
+                res.append(new)
+        segment.clear()
+        return True
+
+    for subcmd in subcmds:
+        if isinstance(subcmd, cmds.ExecuteEnv):
+            if not _flush():
+                return None
+            res.append(subcmd)
+        else:
+            segment.append(subcmd)
+    if not _flush():
+        return None
+    return res
+
+class PassStats(NamedTuple):
+    # How many times the pass was run
+    runs: int = 0
+    # Wall time in seconds
+    time: float = 0.0
+    # Commands (not including comments) removed; negative if added
+    commands_removed: int = 0
+    # Files removed; negative if added
+    files_removed: int = 0
+
 class Optimizer(cmds.FunctionsManager, metaclass=ABCMeta):
+    # Passes (`opt_<name>` methods) that run in this order repeatedly
+    # until none of them changes anything, or `MAX_ROUNDS` is reached.
+    # A pass is skipped when nothing has changed since it last ran and
+    # changed nothing.
+    ITERATED_PASSES = (
+        "empty_functions", "dead_functions", "execute_as_ats",
+        "constants", "dead_functions", "unroll_loops",
+        "function_inliner", "merge_score_ranges", "copy_propagation",
+        "dead_stores",
+    )
+    # Passes that run once after that
+    FINAL_PASSES = (
+        "coalesce_slots", "execute_prefixes", "empty_functions",
+    )
+    MAX_ROUNDS = 4
+
+    # Number of fake players used before and after `opt_coalesce_slots`
+    slot_stats: Optional[Tuple[int, int]] = None
+    # Maximum depth of nested function calls from entries (not
+    # counting recursion), and path of a recursive function if any
+    call_depth_stats: Optional[Tuple[int, Optional[str]]] = None
+    # Statistics of each pass in last `optimize` call
+    pass_stats: Optional[Dict[str, PassStats]] = None
+    # Commands `opt_function_inliner` has added for each function
+    _inline_growth: Optional[Dict[cmds.MCFunctionFile, int]] = None
+    # Last result of `_slot_analysis` and what the files were like
+    _last_analysis: Optional[Tuple[
+        List[Tuple[cmds.MCFunctionFile, List[cmds.Command]]], SlotAnalysis
+    ]] = None
+
+    @classmethod
+    def pass_names(cls) -> List[str]:
+        """Return names of all passes."""
+        return list(dict.fromkeys(cls.ITERATED_PASSES + cls.FINAL_PASSES))
+
+    @property
+    def disabled_passes(self) -> Iterable[str]:
+        """Names of passes that should not run."""
+        return ()
+
     def optimize(self):
         """Start optimizing."""
-        self.opt_empty_functions()
-        self.opt_dead_functions()
-        self.opt_execute_as_ats()
-        self.opt_function_inliner()
+        disabled = set(self.disabled_passes)
+        self.pass_stats = {}
+        self._inline_growth = {}
+        # Bumped whenever a pass changes anything
+        version = 0
+        # Value of `version` when each pass last ran without changing
+        # anything; it has nothing to do until `version` changes. A
+        # pass that changed something may still do more next time.
+        settled: Dict[str, int] = {}
+        for _ in range(self.MAX_ROUNDS):
+            changed = False
+            for name in self.ITERATED_PASSES:
+                if name in disabled or settled.get(name) == version:
+                    continue
+                if self._run_pass(name):
+                    version += 1
+                    changed = True
+                else:
+                    settled[name] = version
+            if not changed:
+                break
+        for name in self.FINAL_PASSES:
+            if name not in disabled:
+                self._run_pass(name)
+        self._last_analysis = None
+        self._update_call_depth()
+
+    def _snapshot(self) -> List[Tuple[cmds.MCFunctionFile,
+                                      List[cmds.Command]]]:
+        """Record current files and commands for `_changed_since`."""
+        return [(file, list(file.commands)) for file in self.files]
+
+    def _changed_since(self, snapshot: List[Tuple[
+        cmds.MCFunctionFile, List[cmds.Command]
+    ]]) -> bool:
+        """Return if any file or command is different from `snapshot`
+        (commands are compared by identity).
+        """
+        return not (len(snapshot) == len(self.files) and all(
+            old is new and len(commands) == len(new.commands)
+            and all(map(operator.is_, commands, new.commands))
+            for (old, commands), new in zip(snapshot, self.files)
+        ))
+
+    def _slot_analysis(self) -> SlotAnalysis:
+        """Return `SlotAnalysis` of all files. The last one is reused
+        if nothing has changed since it was made, which is common as
+        many passes often have nothing to do.
+        """
+        if (self._last_analysis is not None
+                and not self._changed_since(self._last_analysis[0])):
+            return self._last_analysis[1]
+        analysis = SlotAnalysis(self.files, self.default_scb,
+                                self.allocated)
+        self._last_analysis = (self._snapshot(), analysis)
+        return analysis
+
+    def _run_pass(self, name: str) -> bool:
+        """Run pass `name` and return if it changed anything."""
+        before = self._snapshot()
+        command_count = sum(file.cmd_length() for file in self.files)
+        start = time.perf_counter()
+        getattr(self, "opt_" + name)()
+        elapsed = time.perf_counter() - start
+        stats = self.pass_stats.get(name, PassStats())
+        self.pass_stats[name] = PassStats(
+            stats.runs + 1, stats.time + elapsed,
+            stats.commands_removed + command_count
+            - sum(file.cmd_length() for file in self.files),
+            stats.files_removed + len(before) - len(self.files)
+        )
+        return self._changed_since(before)
 
     @abstractmethod
     def entry_files(self) -> Iterable[cmds.MCFunctionFile]:
@@ -26,31 +272,65 @@ class Optimizer(cmds.FunctionsManager, metaclass=ABCMeta):
 
     def opt_dead_functions(self):
         """Remove unreferenced functions."""
-        ref_map: Dict[cmds.MCFunctionFile, Set[cmds.MCFunctionFile]] = {}
-        for file in self.files:
-            refs = set(command.func_ref() for command in file.commands)
-            if None in refs:
-                refs.remove(None)
-            ref_map[file] = refs
-        visited = set()
-        def _visit(file: cmds.MCFunctionFile):
-            if file in visited:
-                return
-            visited.add(file)
-            for ref in ref_map[file]:
-                _visit(ref)
-        for file in self.entry_files():
-            _visit(file)
-        self.files = list(visited)
+        visited = CallGraph(self.files).reachable(self.entry_files())
+        # Keep the original order so that output is deterministic
+        self.files = [file for file in self.files if file in visited]
+
+    @abstractmethod
+    def add_lib(self, file: cmds.MCFunctionFile):
+        """Must be implemented by subclasses to give a path to an
+        internal mcfunction file created by optimizer and add it.
+        """
+        pass
 
     @property
     @abstractmethod
     def max_inline_file_size(self) -> int:
         pass
 
+    @property
+    def call_profile(self) -> Optional[Dict[str, int]]:
+        """Optional profile that maps paths of mcfunctions to how many
+        times they were run, used to guide `opt_function_inliner`.
+        """
+        return None
+
+    # Cost model: estimated time of running commands, in the time a
+    # simple scoreboard command takes.
+    COMMAND_COST = 1
+    SUBCOMMAND_COST = 1
+    # Extra cost of running a /function command, for entering and
+    # leaving the function (excluding the commands in it)
+    FUNCTION_CALL_COST = 20
+    # Extra cost of each kind of target selector, for scanning entities
+    SELECTOR_COSTS = {"e": 8, "a": 2, "p": 2, "r": 2, "s": 0,
+                      "initiator": 0}
+
+    def selector_cost(self, text: str) -> int:
+        """Estimated cost of target selectors in `text`."""
+        return sum(self.SELECTOR_COSTS[kind]
+                   for kind in _SELECTOR.findall(text))
+
+    def subcmd_cost(self, subcmd: cmds._ExecuteSubcmd) -> int:
+        """Estimated cost of evaluating an /execute subcommand."""
+        return self.SUBCOMMAND_COST + self.selector_cost(subcmd.resolve())
+
+    def command_cost(self, command: cmds.Command) -> int:
+        """Estimated cost of running `command` once, assuming all its
+        /execute conditions pass (excluding the commands in the
+        function it calls).
+        """
+        if isinstance(command, cmds.Comment):
+            return 0
+        subcmds, runs = self._resolve_execute(command)
+        cost = self.COMMAND_COST + sum(map(self.subcmd_cost, subcmds))
+        if isinstance(runs, cmds.InvokeFunction):
+            return cost + self.FUNCTION_CALL_COST
+        return cost + self.selector_cost(runs.resolve())
+
     def dont_inline_execute_call(self, file: cmds.MCFunctionFile) -> bool:
         """When True is returned, `execute ... run function` in `file`
-        will not be inlined by `opt_function_inliner`.
+        or to `file` will not be inlined by `opt_function_inliner`.
         """
         return False
 
@@ -62,153 +342,901 @@ class Optimizer(cmds.FunctionsManager, metaclass=ABCMeta):
             c = c.runs
         return subcmds, c
 
+    def _write_analysis(self) -> Optional[Tuple[
+        SlotAnalysis, Dict[cmds.MCFunctionFile, int]
+    ]]:
+        """Return slot analysis of all files and what each function
+        may write, or None if slots can't be analyzed.
+        """
+        analysis = self._slot_analysis()
+        if not analysis.enabled:
+            return None
+        return analysis, analysis.function_writes(self.files)
+
+    def _need_tmp(self, subcmds: List[cmds._ExecuteSubcmd],
+                  callee: cmds.MCFunctionFile,
+                  writes: Optional[Tuple[
+                      SlotAnalysis, Dict[cmds.MCFunctionFile, int]
+                  ]]) -> bool:
+        """Return if commands in `callee` may change result of
+        `subcmds`, given `writes` from `_write_analysis`.
+        """
+        slots = []
+        for subcmd in subcmds:
+            if isinstance(subcmd, cmds.ExecuteCond):
+                return True
+            if isinstance(subcmd, cmds.ExecuteScoreComp):
+                slots.append(subcmd.operand1)
+                slots.append(subcmd.operand2)
+            elif isinstance(subcmd, cmds.ExecuteScoreMatch):
+                slots.append(subcmd.operand)
+            else:
+                unreachable()
+        return self._may_write(cmds.InvokeFunction(callee), slots, writes)
+
+    def _may_write(self, command: cmds.Command,
+                   slots: Iterable[cmds.ScbSlot],
+                   writes: Optional[Tuple[
+                       SlotAnalysis, Dict[cmds.MCFunctionFile, int]
+                   ]]) -> bool:
+        """Return if `command` may change any of `slots`, given
+        `writes` from `_write_analysis`.
+        """
+        if writes is None:
+            return True
+        analysis, func_writes = writes
+        return analysis.may_write(command, slots, func_writes)
+
+    def _inline_saving(self, subcmds: List[cmds._ExecuteSubcmd],
+                       length: int, need_tmp: bool,
+                       probability: float) -> float:
+        """Estimated cost saved each time the call to a function of
+        `length` commands with /execute `subcmds` is replaced by its
+        commands. `probability` is how likely the conditions pass.
+        """
+        if not subcmds:
+            return self.COMMAND_COST + self.FUNCTION_CALL_COST
+        prefix = sum(map(self.subcmd_cost, subcmds))
+        # Commands in callee are dispatched even if conditions fail
+        # after inlining.
+        called = (self.COMMAND_COST + prefix
+                  + probability * (self.FUNCTION_CALL_COST
+                                   + length * self.COMMAND_COST))
+        if need_tmp:
+            inlined = (2 * self.COMMAND_COST + prefix
+                       + probability * self.COMMAND_COST
+                       + length * (self.COMMAND_COST
+                                   + self.SUBCOMMAND_COST))
+        else:
+            inlined = length * (self.COMMAND_COST + prefix)
+        return called - inlined
+
+    def _inline(self, command: cmds.Command, callee: cmds.MCFunctionFile,
+                need_tmp: bool) -> List[cmds.Command]:
+        """Return commands that replace call `command` to `callee`."""
+        subcmds, _ = self._resolve_execute(command)
+        inserts = []
+        if need_tmp:
+            tmp = self.allocate()
+            inserts.append(cmds.ScbSetConst(tmp, 0))
+            inserts.append(cmds.Execute(
+                subcmds, cmds.ScbSetConst(tmp, 1)
+            ))
+            for c in callee.commands:
+                inserts.append(cmds.execute(
+                    [cmds.ExecuteScoreMatch(tmp, "1")], c
+                ))
+        elif subcmds:
+            for c in callee.commands:
+                inserts.append(cmds.execute(subcmds, c))
+        else:
+            inserts.extend(callee.commands)
+        fp = callee.get_path()
+        inserts.insert(0, cmds.Comment(
+            "## Function call to %s inlined by optimizer" % fp
+        ))
+        inserts.append(cmds.Comment("## Inline of %s ended" % fp))
+        return inserts
+
     def opt_function_inliner(self):
-        """Expand mcfunctions that only have 1 reference."""
-        # Locating optimizable
-        todo: Dict[cmds.MCFunctionFile,
-                   Tuple[cmds.MCFunctionFile, int, bool]] = {}
-        called: Set[cmds.MCFunctionFile] = set()
-        for file in self.files:
-            allow_execute = not self.dont_inline_execute_call(file)
-            for i, command in enumerate(file.commands):
-                callee = command.func_ref()
-                if callee is None:
-                    continue
-                if callee in called:
-                    # More than 1 references
-                    if callee in todo:
-                        del todo[callee]
-                    continue
-                called.add(callee)
-                subcmds, runs = self._resolve_execute(command)
-                if not isinstance(runs, cmds.InvokeFunction):
-                    # Not a direct /function call
-                    continue
-                passed_test = (
-                    (not subcmds)
-                    or (
-                        # If there is /execute...
-                        # Caller allows inlining calls with execute
-                        allow_execute
-                        # Environments other than if/unless may change
-                        # during execution of commands, so we can't
-                        # inline it.
-                        and (all([
-                            isinstance(
-                                subcmd, (
-                                    cmds.ExecuteScoreComp,
-                                    cmds.ExecuteScoreMatch,
-                                    cmds.ExecuteCond
-                                )
-                            )
-                            for subcmd in subcmds
-                        ]))
-                    )
-                )
-                if passed_test or callee.cmd_length() == 1:
-                    todo[callee] = (file, i, not passed_test)
-        # Optimize
-        # for callee, (caller, caller_index) in todo.items():
-        #     print("Inlining %s, called by %s at %d" % (
-        #         callee.get_path(), caller.get_path(), caller_index
-        #     ))
-        merged: Set[cmds.MCFunctionFile] = set()
-        def _need_tmp(subcmds, commands: List[cmds.Command]) -> bool:
-            slots = set()
-            for subcmd in subcmds:
-                if isinstance(subcmd, cmds.ExecuteCond):
-                    return True
-                if isinstance(subcmd, cmds.ExecuteScoreComp):
-                    slots.add(subcmd.operand1)
-                    slots.add(subcmd.operand2)
-                elif isinstance(subcmd, cmds.ExecuteScoreMatch):
-                    slots.add(subcmd.operand)
-                else:
-                    unreachable()
-            for command in commands:
-                for slot in slots:
-                    if command.scb_did_assign(slot):
-                        return True
-            return False
-        def _merge(caller: cmds.MCFunctionFile):
-            if caller in merged:
+        """Expand calls to mcfunctions where the cost model says it is
+        cheaper, weighted by `call_profile` if there is one. Code
+        growth for each function is limited to `max_inline_file_size`
+        commands.
+        """
+        entries = set(self.entry_files())
+        profile = self.call_profile
+        graph = CallGraph(self.files)
+        writes = self._write_analysis()
+        growths = self._inline_growth
+        if growths is None:
+            growths = {}
+        # Call sites to inline and whether they need a tmp slot
+        todo: Dict[Tuple[cmds.MCFunctionFile, int], bool] = {}
+        removed: Set[cmds.MCFunctionFile] = set()
+        def _runs(file: cmds.MCFunctionFile) -> int:
+            if profile is None:
+                return 1
+            return profile.get(file.get_path(), 0)
+        def _inlinable(caller: cmds.MCFunctionFile, index: int,
+                       callee: cmds.MCFunctionFile, length: int) -> bool:
+            subcmds, runs = self._resolve_execute(caller.commands[index])
+            if not isinstance(runs, cmds.InvokeFunction):
+                # Not a direct /function call
+                return False
+            if not subcmds or length == 1:
+                return True
+            # Environments other than if/unless may change during
+            # execution of commands, so we can't inline it.
+            return (not self.dont_inline_execute_call(caller)
+                    and not self.dont_inline_execute_call(callee)
+                    and all(isinstance(subcmd, (
+                                cmds.ExecuteScoreComp,
+                                cmds.ExecuteScoreMatch,
+                                cmds.ExecuteCond
+                            )) for subcmd in subcmds))
+        def _decide(callee: cmds.MCFunctionFile):
+            callee_sites = graph.sites.get(callee)
+            if not callee_sites:
                 return
-            merged.add(caller)
-            tasks: List[Tuple[int, cmds.MCFunctionFile, bool]] = []
-            for callee, (caller_got, caller_index, ensure_l1) in todo.items():
-                if caller_got != caller:
+            if profile is None:
+                probability = 1.0
+            else:
+                total = sum(map(_runs, (c for c, _ in callee_sites)))
+                probability = min(_runs(callee) / total, 1.0) \
+                    if total else 0.0
+            length = callee.cmd_length()
+            candidates = []
+            for caller, index in callee_sites:
+                if not _inlinable(caller, index, callee, length):
                     continue
-                _merge(callee)
-                tasks.append((caller_index, callee, ensure_l1))
-            tasks.sort(key=lambda x: x[0], reverse=True)
-            for index, callee, ensure_len1 in tasks:
                 subcmds, _ = self._resolve_execute(caller.commands[index])
-                callee_len = callee.cmd_length()
-                # Here `runs` must be /function that calls `callee`
-                if subcmds and callee_len > self.max_inline_file_size:
-                    # Prefixing every command in a long file with
-                    # /execute condition can reduce performance,
-                    # so we don't inline it.
-                    continue
-                if ensure_len1 and callee_len != 1:
-                    continue
-                # print("Merging %s to %s:%d" % (
-                #     callee.get_path(), caller.get_path(), index
-                # ))
-                inserts = []
                 # No need for tmp if callee has only 1 command
-                if callee_len != 1 and _need_tmp(subcmds, callee.commands):
-                    tmp = self.allocate()
-                    inserts.append(cmds.ScbSetConst(tmp, 0))
-                    inserts.append(cmds.Execute(
-                        subcmds, cmds.ScbSetConst(tmp, 1)
-                    ))
-                    for command in callee.commands:
-                        inserts.append(cmds.execute(
-                            [cmds.ExecuteScoreMatch(tmp, "1")], command
+                need_tmp = (length != 1 and bool(subcmds)
+                            and self._need_tmp(subcmds, callee, writes))
+                saving = _runs(caller) * self._inline_saving(
+                    subcmds, length, need_tmp, probability
+                )
+                if saving <= 0:
+                    continue
+                growth = length + (2 if need_tmp else 0) - 1
+                candidates.append((saving, growth, caller, index, need_tmp))
+            # Budget is shared by all runs of this pass in `optimize`
+            budget = self.max_inline_file_size - growths.get(callee, 0)
+            if len(candidates) == len(callee_sites) \
+                    and callee not in entries:
+                # Inlining all the calls removes the function
+                if sum(c[1] for c in candidates) - length <= budget:
+                    for _, _, caller, index, need_tmp in candidates:
+                        todo[(caller, index)] = need_tmp
+                    removed.add(callee)
+                    return
+            # Prefer calls that save more
+            candidates.sort(key=lambda c: c[0], reverse=True)
+            for _, growth, caller, index, need_tmp in candidates:
+                if growth > budget:
+                    break
+                budget -= growth
+                growths[callee] = growths.get(callee, 0) + growth
+                todo[(caller, index)] = need_tmp
+        # Callees are processed before callers, so a function is only
+        # inlined after the calls in it are.
+        for component in graph.components():
+            for file in component:
+                commands = []
+                for index, command in enumerate(file.commands):
+                    need_tmp = todo.get((file, index))
+                    if need_tmp is None:
+                        commands.append(command)
+                    else:
+                        commands.extend(self._inline(
+                            command, command.func_ref(), need_tmp
                         ))
-                elif subcmds:
-                    for command in callee.commands:
-                        inserts.append(cmds.execute(subcmds, command))
-                else:
-                    inserts.extend(callee.commands)
-                fp = callee.get_path()
-                inserts.insert(0, cmds.Comment(
-                    "## Function call to %s inlined by optimizer" % fp
-                ))
-                inserts.append(cmds.Comment("## Inline of %s ended" % fp))
-                caller.commands[index : index+1] = inserts
-                self.files.remove(callee)
-        for caller, _, _ in todo.values():
-            if caller not in todo:
-                _merge(caller)
+                file.commands = commands
+            # Recursive functions are never inlined
+            if not graph.is_recursive(component):
+                _decide(component[0])
+        self.files = [file for file in self.files if file not in removed]
+
+    def _loop_tails(self) -> Dict[cmds.MCFunctionFile, int]:
+        """Find loops, i.e. functions whose last command calls
+        themselves with only score conditions and other commands
+        don't. Return a dict that maps them to index of that call.
+        """
+        res = {}
+        for file in self.files:
+            indexes = [i for i, command in enumerate(file.commands)
+                       if not isinstance(command, cmds.Comment)]
+            if not indexes:
+                continue
+            tail = indexes[-1]
+            subcmds, runs = self._resolve_execute(file.commands[tail])
+            if (isinstance(runs, cmds.InvokeFunction)
+                    and runs.file is file
+                    and all(isinstance(subcmd, (cmds.ExecuteScoreComp,
+                                                cmds.ExecuteScoreMatch))
+                            for subcmd in subcmds)
+                    and all(command.func_ref() is not file
+                            for command in file.commands[:tail])):
+                res[file] = tail
+        return res
+
+    def _constant_loop_unroller(self, prop: ConstPropagation) \
+            -> Optional[Callable[[cmds.Command, ConstState],
+                                 Union[cmds.Command, List[cmds.Command]]]]:
+        """Return a rewrite (see `_rewrite_with_constants`) that
+        replaces calls to loops whose number of iterations is known
+        with copies of the loop body, when code does not grow by more
+        than `max_inline_file_size` commands. Return None if there is
+        no loop.
+        """
+        tails = self._loop_tails()
+        if not tails:
+            return None
+        sizes = {loop: max(loop.cmd_length() - 1, 1) for loop in tails}
+        def _unroll(command: cmds.Command, state: ConstState):
+            subcmds, runs = self._resolve_execute(command)
+            if (not isinstance(runs, cmds.InvokeFunction)
+                    or runs.file not in tails):
+                return command
+            loop = runs.file
+            tail = tails[loop]
+            body = loop.commands[:tail]
+            tail_subcmds, _ = self._resolve_execute(loop.commands[tail])
+            size = sizes[loop]
+            state = dict(state)
+            trips = 0
+            passed = _conditions_pass(subcmds, state)
+            while passed:
+                trips += 1
+                if trips * size - 1 > self.max_inline_file_size:
+                    return command
+                for c in body:
+                    prop.step(c, state, _ignore_call)
+                passed = _conditions_pass(tail_subcmds, state)
+            if passed is None or trips == 0:
+                return command
+            fp = loop.get_path()
+            res = [cmds.Comment(
+                "## Loop %s unrolled by optimizer (%d iterations)"
+                % (fp, trips)
+            )]
+            for _ in range(trips):
+                res.extend(body)
+            res.append(cmds.Comment("## Unrolled loop %s ended" % fp))
+            return res
+        return _unroll
+
+    def opt_unroll_loops(self):
+        """Put a copy of loop body in place of the call to itself at
+        the end of a loop when the cost model says it is cheaper.
+        This halves function calls made by the loop and how deep
+        they are nested.
+        """
+        tails = self._loop_tails()
+        if not tails:
+            return
+        writes = self._write_analysis()
+        # Share growth budget with `opt_function_inliner`
+        growths = self._inline_growth
+        if growths is None:
+            growths = {}
+        for loop, tail in tails.items():
+            subcmds, _ = self._resolve_execute(loop.commands[tail])
+            length = loop.cmd_length()
+            need_tmp = (length != 1 and bool(subcmds)
+                        and self._need_tmp(subcmds, loop, writes))
+            growth = length + (2 if need_tmp else 0) - 1
+            if (growths.get(loop, 0) + growth <= self.max_inline_file_size
+                    and self._inline_saving(subcmds, length, need_tmp,
+                                            1.0) > 0):
+                growths[loop] = growths.get(loop, 0) + growth
+                loop.commands[tail : tail+1] = self._inline(
+                    loop.commands[tail], loop, need_tmp
+                )
+
+    def _update_call_depth(self):
+        """Find out how deep function calls can nest from entries."""
+        def _invoked(command: cmds.Command) \
+                -> Optional[cmds.MCFunctionFile]:
+            _, runs = self._resolve_execute(command)
+            if isinstance(runs, cmds.InvokeFunction):
+                return runs.file
+            return None
+        graph = CallGraph(self.files, _invoked)
+        reachable = graph.reachable(self.entry_files())
+        depths: Dict[cmds.MCFunctionFile, int] = {}
+        recursive = None
+        for component in graph.components():
+            if (recursive is None and component[0] in reachable
+                    and graph.is_recursive(component)):
+                recursive = component[0]
+            # Calls inside a component are recursion
+            depth = 1 + max((depths[callee]
+                             for file in component
+                             for callee in graph.callees[file]
+                             if callee in depths), default=0)
+            for file in component:
+                depths[file] = depth
+        depth = max((depths[file] for file in self.entry_files()
+                     if file in depths), default=0)
+        self.call_depth_stats = (
+            depth, recursive.get_path() if recursive is not None else None
+        )
 
     def opt_execute_as_ats(self):
         """Remove "as @s" in /execute commands. """
         for file in self.files:
             for i, command in enumerate(file.commands):
                 if isinstance(command, cmds.Execute):
-                    for j, subcmd in enumerate(command.subcmds):
-                        if (isinstance(subcmd, cmds.ExecuteEnv)
+                    subcmds = [
+                        subcmd for subcmd in command.subcmds
+                        if not (isinstance(subcmd, cmds.ExecuteEnv)
                                 and subcmd.cmd == "as"
-                                and subcmd.args == "@s"):
-                            del command.subcmds[j]
-                    if not command.subcmds:
+                                and subcmd.args == "@s")
+                    ]
+                    if len(subcmds) == len(command.subcmds):
+                        continue
+                    if subcmds:
+                        file.commands[i] = cmds.Execute(subcmds,
+                                                        command.runs)
+                    else:
                         # /execute with only a run subcommand can get
                         # rid of the /execute.
                         file.commands[i] = command.runs
 
-    def opt_empty_functions(self):
-        """Remove definition and invoke of empty functions."""
-        removed = set()
-        for i, file in reversed(tuple(enumerate(self.files))):
-            if not file.has_content():
-                removed.add(file)
-                del self.files[i]
+    def opt_merge_score_ranges(self):
+        """Merge "if score" ranges checked on the same slot in an
+        /execute into one, remove those that always pass, and remove
+        /execute whose ranges never overlap.
+        """
         for file in self.files:
-            for i, command in enumerate(file.commands):
-                ref = command.func_ref()
-                if ref is not None and ref in removed:
-                    file.commands[i] = cmds.Comment(
-                        "## (Calling empty function) %s" % command.resolve()
+            commands = []
+            for command in file.commands:
+                if isinstance(command, cmds.Execute):
+                    subcmds = _merge_ranges(command.subcmds)
+                    if subcmds is None:
+                        # Never runs
+                        continue
+                    if not subcmds:
+                        command = command.runs
+                    elif (len(subcmds) != len(command.subcmds)
+                          or not all(map(operator.is_, subcmds,
+                                         command.subcmds))):
+                        command = cmds.Execute(subcmds, command.runs)
+                commands.append(command)
+            file.commands = commands
+
+    def opt_empty_functions(
+        self, keep: Optional[Iterable[cmds.MCFunctionFile]] = None
+    ):
+        """Remove definition and invoke of empty functions, except
+        those in `keep` (default to entry files, since they can still
+        be called by players).
+        """
+        keep = set(self.entry_files() if keep is None else keep)
+        removed = set(file for file in self.files
+                      if file not in keep and not file.has_content())
+        if not removed:
+            return
+        self.files = [file for file in self.files if file not in removed]
+        graph = CallGraph(self.files)
+        for file in removed:
+            for caller, i in graph.sites.get(file, ()):
+                caller.commands[i] = cmds.Comment(
+                    "## (Calling empty function) %s"
+                    % caller.commands[i].resolve()
+                )
+
+    def _replace_slots(self, command: cmds.Command,
+                       slots: Dict[cmds.ScbSlot, cmds.ScbSlot],
+                       reads_only=False) -> cmds.Command:
+        """Return a command that uses `slots[x]` where `command` uses
+        slot `x`. If `reads_only` is True, slots that are written are
+        left unchanged. `command` itself is never modified since
+        commands and subcommands may be shared.
+        """
+        if isinstance(command, cmds.Execute):
+            subcmds = []
+            for subcmd in command.subcmds:
+                if (isinstance(subcmd, cmds.ExecuteScoreComp)
+                        and (subcmd.operand1 in slots
+                             or subcmd.operand2 in slots)):
+                    subcmd = cmds.ExecuteScoreComp(
+                        slots.get(subcmd.operand1, subcmd.operand1),
+                        slots.get(subcmd.operand2, subcmd.operand2),
+                        subcmd.operator, subcmd.invert
                     )
+                elif (isinstance(subcmd, cmds.ExecuteScoreMatch)
+                        and subcmd.operand in slots):
+                    subcmd = cmds.ExecuteScoreMatch(
+                        slots[subcmd.operand], subcmd.range, subcmd.invert
+                    )
+                subcmds.append(subcmd)
+            runs = self._replace_slots(command.runs, slots, reads_only)
+            if runs is command.runs and all(
+                a is b for a, b in zip(subcmds, command.subcmds)
+            ):
+                return command
+            return cmds.Execute(subcmds, runs)
+        if isinstance(command, cmds.ScbOperation):
+            if reads_only:
+                if (command.operator is not cmds.ScbOp.SWAP
+                        and command.operand2 in slots):
+                    return cmds.ScbOperation(
+                        command.operator, command.operand1,
+                        slots[command.operand2]
+                    )
+            elif command.operand1 in slots or command.operand2 in slots:
+                return cmds.ScbOperation(
+                    command.operator,
+                    slots.get(command.operand1, command.operand1),
+                    slots.get(command.operand2, command.operand2)
+                )
+            return command
+        if (isinstance(command, cmds.RawtextOutput)
+                and any(slot in slots for slot in command.score_slots)):
+            return cmds.RawtextOutput(
+                command.prefix, _map_rawtext_slots(command.rawtext, slots)
+            )
+        if reads_only:
+            return command
+        if (isinstance(command, (cmds.ScbSetConst, cmds.ScbAddConst,
+                                 cmds.ScbRemoveConst))
+                and command.target in slots):
+            return type(command)(slots[command.target], command.value)
+        if isinstance(command, cmds.ScbRandom) and command.target in slots:
+            return cmds.ScbRandom(slots[command.target],
+                                  command.min, command.max)
+        return command
+
+    def opt_copy_propagation(self):
+        """After `x = y`, let following commands read `y` instead of
+        `x` until either of them is changed, and remove copies that
+        do nothing. This may leave `x = y` dead so that
+        `opt_dead_stores` can remove it.
+        """
+        analysis = self._slot_analysis()
+        if not analysis.enabled:
+            return
+        func_writes = analysis.function_writes(self.files)
+        for file in self.files:
+            # Maps `x` to `y` when `x` is known to be equal to `y`
+            copies: Dict[cmds.ScbSlot, cmds.ScbSlot] = {}
+            commands: List[cmds.Command] = []
+            for command in file.commands:
+                if copies:
+                    command = self._replace_slots(command, copies,
+                                                  reads_only=True)
+                subcmds, runs = self._resolve_execute(command)
+                if (isinstance(runs, cmds.ScbOperation)
+                        and runs.operator is cmds.ScbOp.ASSIGN
+                        and (runs.operand1 == runs.operand2
+                             or copies.get(runs.operand1) == runs.operand2)):
+                    # The slot already has that value
+                    continue
+                access = analysis.access(command)
+                writes = access.writes
+                if access.callee is not None:
+                    writes |= func_writes.get(access.callee,
+                                              analysis.all_slots)
+                if writes:
+                    for x, y in tuple(copies.items()):
+                        if analysis.mask(x, y) & writes:
+                            del copies[x]
+                if (not subcmds
+                        and isinstance(runs, cmds.ScbOperation)
+                        and runs.operator is cmds.ScbOp.ASSIGN
+                        and analysis.tracked(runs.operand1)
+                        and analysis.tracked(runs.operand2)):
+                    copies[runs.operand1] = runs.operand2
+                commands.append(command)
+            file.commands = commands
+
+    def opt_dead_stores(self):
+        """Remove scoreboard commands whose results are never read."""
+        removed = True
+        while removed:
+            removed = False
+            analysis = self._slot_analysis()
+            if not analysis.enabled:
+                return
+            live_in, live_out = analysis.liveness(
+                self.files, self.entry_files()
+            )
+            for file in self.files:
+                live = live_out[file]
+                commands: List[cmds.Command] = []
+                for command in reversed(file.commands):
+                    access = analysis.access(command)
+                    _, runs = self._resolve_execute(command)
+                    slots = written_slots(runs)
+                    if (slots is not None
+                            and all(map(analysis.tracked, slots))
+                            and not access.writes & live):
+                        removed = True
+                        continue
+                    live = analysis.live_before(access, live, live_in)
+                    commands.append(command)
+                commands.reverse()
+                file.commands = commands
+
+    def _const_propagation(self) -> Optional[ConstPropagation]:
+        analysis = self._slot_analysis()
+        if not analysis.enabled:
+            return None
+        # Integer constants are loaded once and keep their values
+        # unless some command changes them.
+        consts = {slot: value for value, slot in self._int_consts.items()
+                  if analysis.tracked(slot)}
+        for file in self.files:
+            for command in file.commands:
+                writes = analysis.access(command).writes
+                if not writes:
+                    continue
+                _, runs = self._resolve_execute(command)
+                for slot, value in tuple(consts.items()):
+                    if (analysis.mask(slot) & writes and not (
+                        isinstance(runs, cmds.ScbSetConst)
+                        and runs.value == value
+                    )):
+                        del consts[slot]
+        return ConstPropagation(analysis, self.files, self.entry_files(),
+                                consts)
+
+    def _rewrite_with_constants(
+        self, rewrites: Iterable[Callable[[cmds.Command, ConstState], Union[
+            None, cmds.Command, List[cmds.Command]
+        ]]],
+        prop: ConstPropagation
+    ):
+        """Replace every reachable command with what `rewrites` return
+        when given the command and the known slot values before it;
+        None means removing the command, and a list means replacing it
+        with several commands. Each of `rewrites` is given what the
+        ones before it return, in one walk over the commands.
+        """
+        rewrites = tuple(rewrites)
+        for file in self.files:
+            state = prop.entry_states[file]
+            if state is None:
+                # Never reached
+                continue
+            state = dict(state)
+            commands: List[cmds.Command] = []
+            def _emit(command: cmds.Command, level: int):
+                if level == len(rewrites):
+                    prop.step(command, state, _ignore_call)
+                    commands.append(command)
+                    return
+                new = rewrites[level](command, state)
+                if new is None:
+                    return
+                if not isinstance(new, list):
+                    new = [new]
+                for command in new:
+                    _emit(command, level + 1)
+            for command in file.commands:
+                _emit(command, 0)
+            file.commands = commands
+
+    def opt_constants(self):
+        """Find out slots whose values are known (including those
+        passed to functions as arguments), then in one walk:
+        unroll loops whose number of iterations is known, remove
+        /execute that never runs and score conditions that always
+        pass, and replace scoreboard operations whose operand 2 is
+        known with cheaper commands that don't read it (like add,
+        remove and set), or remove them when they do nothing.
+        Constants that are no longer read are then removed from
+        initialization by `opt_dead_stores`.
+        """
+        prop = self._const_propagation()
+        if prop is None:
+            return
+        def fold_operands(command: cmds.Command, state: ConstState):
+            return self._fold_operands(command, state, prop.analysis)
+        rewrites = [self._fold_conditions, fold_operands]
+        unroll = self._constant_loop_unroller(prop)
+        if unroll is not None:
+            rewrites.insert(0, unroll)
+        self._rewrite_with_constants(rewrites, prop)
+
+    @staticmethod
+    def _fold_conditions(command: cmds.Command, state: ConstState) \
+            -> Optional[cmds.Command]:
+        """Remove `command` if it is an /execute that never runs, or
+        remove its score conditions that always pass.
+        """
+        if not isinstance(command, cmds.Execute):
+            return command
+        results = [eval_condition(subcmd, state)
+                   for subcmd in command.subcmds]
+        if False in results:
+            return None
+        if True not in results:
+            return command
+        subcmds = [subcmd for subcmd, result
+                   in zip(command.subcmds, results)
+                   if result is not True]
+        if not subcmds:
+            return command.runs
+        return cmds.Execute(subcmds, command.runs)
+
+    def _fold_operands(self, command: cmds.Command, state: ConstState,
+                       analysis: SlotAnalysis) -> Optional[cmds.Command]:
+        """Fold scoreboard operation in `command` whose operand 2 is
+        known (see `_fold_operation`). Operand 1 must be analyzed:
+        the folded command may test or read it, which means something
+        else when it is a selector that matches several entities.
+        """
+        subcmds, runs = self._resolve_execute(command)
+        if (not isinstance(runs, cmds.ScbOperation)
+                or runs.operator is cmds.ScbOp.SWAP
+                or runs.operand1 == runs.operand2
+                or not analysis.tracked(runs.operand1)
+                or runs.operand2 not in state):
+            return command
+        new = self._fold_operation(runs, state[runs.operand2])
+        if new is runs:
+            return command
+        if new is None:
+            return None
+        return cmds.execute(subcmds, new) if subcmds else new
+
+    def _fold_operation(self, command: cmds.ScbOperation, value: int) \
+            -> Optional[cmds.Command]:
+        """Return the cheapest command that does the same thing as
+        `command` whose operand 2 has a known `value`. Return None
+        if it does nothing.
+        """
+        target, op = command.operand1, command.operator
+        if op is cmds.ScbOp.SUB_EQ and value != INT_MIN:
+            op, value = cmds.ScbOp.ADD_EQ, -value
+        if op is cmds.ScbOp.ASSIGN:
+            return cmds.ScbSetConst(target, value)
+        if op is cmds.ScbOp.ADD_EQ:
+            if value == 0:
+                return None
+            if value > 0:
+                return cmds.ScbAddConst(target, value)
+            if value != INT_MIN:
+                return cmds.ScbRemoveConst(target, -value)
+        elif op is cmds.ScbOp.MUL_EQ:
+            if value == 1:
+                return None
+            if value == 0:
+                return cmds.ScbSetConst(target, 0)
+            if value == 2:
+                # Doubling needs no constant. Larger powers of 2 are
+                # left alone since each doubling costs a command.
+                return cmds.ScbOperation(cmds.ScbOp.ADD_EQ, target, target)
+        elif op is cmds.ScbOp.DIV_EQ:
+            if value == 1:
+                return None
+        elif op is cmds.ScbOp.MOD_EQ:
+            if value in (1, -1):
+                return cmds.ScbSetConst(target, 0)
+        elif op is cmds.ScbOp.MIN:
+            if value == INT_MAX:
+                return None
+            return cmds.Execute(
+                [cmds.ExecuteScoreMatch(target, "%d.." % (value + 1))],
+                cmds.ScbSetConst(target, value)
+            )
+        elif op is cmds.ScbOp.MAX:
+            if value == INT_MIN:
+                return None
+            return cmds.Execute(
+                [cmds.ExecuteScoreMatch(target, "..%d" % (value - 1))],
+                cmds.ScbSetConst(target, value)
+            )
+        return command
+
+    def opt_coalesce_slots(self):
+        """Let slots that are never live at the same time share one
+        fake player, like register allocation. Copies between slots
+        that get merged are removed. Only slots from `allocate` are
+        renamed; scores that players can see keep their holders.
+        """
+        analysis = self._slot_analysis()
+        before = analysis.slot_count
+        if not analysis.enabled:
+            self.slot_stats = (before, before)
+            return
+        live_in, live_out = analysis.liveness(
+            self.files, self.entry_files()
+        )
+        # Build interference graph: `interference[i]` has the slots
+        # that are live when slot i is written. Other slots that
+        # interfere with i have i in their own entry.
+        interference = [0] * len(analysis.slots)
+        # Pairs of slots that are copied to each other
+        copies: List[Tuple[int, int]] = []
+        for file in self.files:
+            live = live_out[file]
+            for command in reversed(file.commands):
+                access = analysis.access(command)
+                writes = access.writes
+                if writes:
+                    others = live
+                    subcmds, runs = self._resolve_execute(command)
+                    if (not subcmds
+                            and isinstance(runs, cmds.ScbOperation)
+                            and runs.operator is cmds.ScbOp.ASSIGN):
+                        # After `x = y`, x and y have the same value so
+                        # y being live doesn't stop them sharing.
+                        src = analysis.mask(runs.operand2)
+                        others &= ~src
+                        if src:
+                            copies.append((writes, src))
+                    while writes:
+                        bit = writes & -writes
+                        writes ^= bit
+                        interference[bit.bit_length() - 1] |= others & ~bit
+                live = analysis.live_before(access, live, live_in)
+        preferred: Dict[int, List[int]] = {}
+        for a, b in copies:
+            preferred.setdefault(a, []).append(b)
+            preferred.setdefault(b, []).append(a)
+        # Greedily put each slot into the first group it doesn't
+        # interfere with, trying groups of slots it is copied with
+        # first. Slots we can't rename stay alone.
+        fixed = analysis.hooked_slots
+        groups: List[List[int]] = []  # [leader index, members, edges]
+        group_of: Dict[int, List[int]] = {}
+        mapping: Dict[cmds.ScbSlot, cmds.ScbSlot] = {}
+        for i, slot in enumerate(analysis.slots):
+            bit = 1 << i
+            if bit & fixed:
+                continue
+            edges = interference[i]
+            candidates = [group_of[other] for other in preferred.get(bit, ())
+                          if other in group_of]
+            candidates.extend(groups)
+            for group in candidates:
+                if not (group[1] & edges or group[2] & bit):
+                    group[1] |= bit
+                    group[2] |= edges
+                    mapping[slot] = analysis.slots[group[0]]
+                    break
+            else:
+                group = [i, bit, edges]
+                groups.append(group)
+            group_of[bit] = group
+        for file in self.files:
+            commands: List[cmds.Command] = []
+            for command in file.commands:
+                command = self._replace_slots(command, mapping)
+                _, runs = self._resolve_execute(command)
+                if (isinstance(runs, cmds.ScbOperation)
+                        and runs.operator in (cmds.ScbOp.ASSIGN,
+                                              cmds.ScbOp.SWAP)
+                        and runs.operand1 == runs.operand2):
+                    continue
+                commands.append(command)
+            file.commands = commands
+        after = self._slot_analysis().slot_count
+        self.slot_stats = (before, after)
+
+    # Commands that only make sounds or particles: they don't change
+    # anything /execute subcommands can check, and the order they run
+    # in for different entities doesn't matter.
+    EFFECT_ONLY_COMMANDS = ("playsound", "particle")
+
+    def _is_effect_only(self, command: cmds.Command) -> bool:
+        return (isinstance(command, cmds.Cmd)
+                and command.value.split(" ", 1)[0]
+                    in self.EFFECT_ONLY_COMMANDS)
+
+    def _prefix_group(
+        self, commands: List[cmds.Command], start: int,
+        writes: Optional[Tuple[SlotAnalysis,
+                               Dict[cmds.MCFunctionFile, int]]]
+    ) -> Optional[Tuple[int, int]]:
+        """Find commands from `start` that can share the longest
+        /execute subcommand prefix in a function, and it is worth
+        doing so. `writes` is from `_write_analysis`.
+        Return (end index, prefix length) or None.
+        """
+        first = commands[start]
+        if not isinstance(first, cmds.Execute):
+            return None
+        prefix = first.subcmds
+        keys = [subcmd.resolve() for subcmd in prefix]
+        length = len(prefix)
+        effect_only = True
+        last: Optional[cmds.Command] = None
+        count = 0
+        best: Optional[Tuple[int, int]] = None
+        best_saving = 0
+        for end in range(start + 1, len(commands) + 1):
+            command = commands[end - 1]
+            if isinstance(command, cmds.Comment):
+                continue
+            if not isinstance(command, cmds.Execute):
+                break
+            if last is not None:
+                # Prefix must not be changed by previous commands
+                # since it is only checked once after hoisting.
+                for i, subcmd in enumerate(prefix[:length]):
+                    if isinstance(subcmd, cmds.ExecuteScoreComp):
+                        slots = (subcmd.operand1, subcmd.operand2)
+                    elif isinstance(subcmd, cmds.ExecuteScoreMatch):
+                        slots = (subcmd.operand,)
+                    else:
+                        continue
+                    if (not self._is_effect_only(last.runs)
+                            and (isinstance(last.runs, cmds.Cmd)
+                                 or self._may_write(last.runs, slots,
+                                                    writes))):
+                        length = i
+                        break
+            i = 0
+            while (i < length and i < len(command.subcmds)
+                    and command.subcmds[i].resolve() == keys[i]):
+                i += 1
+            length = i
+            effect_only = effect_only and self._is_effect_only(command.runs)
+            if not effect_only:
+                # Executing commands for each entity one by one is
+                # different from executing them in order for every
+                # entity. Also, conditions on entities or blocks may
+                # be changed by the commands.
+                for i, subcmd in enumerate(prefix[:length]):
+                    if not (isinstance(subcmd, (cmds.ExecuteScoreComp,
+                                                cmds.ExecuteScoreMatch))
+                            and not subcmd.resolve().split()[2]
+                                .startswith("@")):
+                        length = i
+                        break
+            if length == 0:
+                break
+            count += 1
+            last = command
+            # Each of the `count` commands evaluates the prefix no
+            # more, while the new command that calls the function
+            # evaluates it once and costs itself and the function call.
+            prefix_cost = sum(map(self.subcmd_cost, prefix[:length]))
+            saving = ((count - 1) * prefix_cost - self.COMMAND_COST
+                      - self.FUNCTION_CALL_COST)
+            if saving > best_saving:
+                best_saving = saving
+                best = (end, length)
+        return best
+
+    def opt_execute_prefixes(self):
+        """Move consecutive /execute commands that share the same
+        subcommands at the beginning into a new function, and call it
+        with those subcommands once, when the cost model says it is
+        cheaper.
+        """
+        writes = self._write_analysis()
+        todo = list(self.files)
+        while todo:
+            file = todo.pop()
+            commands: List[cmds.Command] = []
+            i = 0
+            while i < len(file.commands):
+                group = self._prefix_group(file.commands, i, writes)
+                if group is None:
+                    commands.append(file.commands[i])
+                    i += 1
+                    continue
+                end, length = group
+                prefix = file.commands[i].subcmds[:length]
+                lib = cmds.MCFunctionFile()
+                for command in file.commands[i:end]:
+                    if isinstance(command, cmds.Execute):
+                        subcmds = command.subcmds[length:]
+                        if subcmds:
+                            command = cmds.Execute(subcmds, command.runs)
+                        else:
+                            command = command.runs
+                    lib.commands.append(command)
+                self.add_lib(lib)
+                todo.append(lib)
+                commands.append(cmds.Execute(prefix,
+                                             cmds.InvokeFunction(lib)))
+                i = end
+            file.commands = commands
@@ -3,17 +3,7 @@ music - Generate redstone music from MIDI file
 NOTE Python package `mido` is required.
 """
 
-from typing import Dict, TYPE_CHECKING
-try:
-    from itertools import pairwise
-except ImportError:
-    def pairwise(iterable):
-        """A clone of itertools.pairwise for Python 3.9 or below."""
-        iterator = iter(iterable)
-        last = next(iterator, None)
-        for current in iterator:
-            yield last, current
-            last = current
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
 
 from acaciamc.objects import *
 from acaciamc.mccmdgen.expr import *
@@ -196,6 +186,9 @@ class MusicType(Type):
         volume: float = 1.0,
         channel_volume: map[int-literal, float] = {:},
         instrument: map[int-literal, str] = {:},
+        group_notes: bool-literal = True,
+        max_polyphony: int-literal | None = None,
+        min_volume: float = 0.0,
     )
 
     A music to generate from MIDI file `path`.
@@ -204,10 +197,9 @@ class MusicType(Type):
     `listener` specifies who would hear the music.
     `note_offset` would make the whole music higher if it is positive,
     or lower if negative.
-    Since music runs a LOT of commands every tick, we seperate commands
-    into several files to make sure you are not running too many commands
-    every tick. `chunk_size` determines how many commands there will be
-    in 1 file.
+    Notes of each game tick are put in their own file, so only the
+    notes being played run every tick. `chunk_size` is no longer used
+    and is kept for compatibility.
     `speed` sets the speed of music.
     `volume` sets the overall volume of music.
     `channel_volume` sets the volume factor of each MIDI channel (0-15).
@@ -215,6 +207,13 @@ class MusicType(Type):
     `instrument` sets the corresponding Minecraft sound of each MIDI
     instrument (0-127). The default mapping is in `ID2INSTRUMENT`. An
     example: {127: "note.hat"}.
+    If `group_notes` is True, notes in the same game tick are played
+    in one function run as and at `listener`, so that the selector is
+    only evaluated once for a chord.
+    `max_polyphony` limits how many notes can be played in one game
+    tick; the loudest notes are kept. None means no limit.
+    Notes quieter than `min_volume` (after applying `volume` and
+    `channel_volume`) are dropped.
     """
     def do_init(self):
         @cmethod_of(self, "__new__")
@@ -233,10 +232,16 @@ class MusicType(Type):
         @axe.arg("instrument", axe.MapOf(
             axe.RangedLiteralInt(0, 127), axe.LiteralString()
         ), default={})
+        @axe.arg("group_notes", axe.LiteralBool(), default=True)
+        @axe.arg("max_polyphony", axe.Nullable(axe.RangedLiteralInt(1, None)),
+                 default=None)
+        @axe.arg("min_volume", axe.LiteralFloat(), default=0.0)
         def _new(compiler, path: str, looping: bool, loop_interval: int,
                  listener: "MCSelector", note_offset: int,
                  chunk_size: int, speed: float, volume: float,
-                 channel_volume: Dict[int, float], instrument: Dict[int, str]):
+                 channel_volume: Dict[int, float], instrument: Dict[int, str],
+                 group_notes: bool, max_polyphony: Optional[int],
+                 min_volume: float):
             try:
                 midi = mido.MidiFile(path)
             except OSError as err:
@@ -245,6 +250,7 @@ class MusicType(Type):
                     message=localize("modules.music.doinit.midiparser")
                         % err.strerror
                 )
+            compiler.add_dependency(path)
             if speed <= 0:
                 raise axe.ArgumentError(
                     "speed", localize("modules.music.doinit.mustpos")
@@ -264,8 +270,8 @@ class MusicType(Type):
                 listener_str = listener.to_str()
             return Music(
                 midi, listener_str, looping_info, note_offset,
-                chunk_size, speed, volume, channel_volume, instrument,
-                compiler
+                speed, volume, channel_volume, instrument, group_notes,
+                max_polyphony, min_volume, compiler
             )
 
     def datatype_hook(self):
@@ -281,16 +287,16 @@ class Music(ConstExprCombined):
     cdata_type = ctdt_music
 
     def __init__(self, midi, listener_str: str, looping: int,
-                 note_offset: int, chunk_size: int, speed: float,
+                 note_offset: int, speed: float,
                  volume: float, channel_volume: Dict[int, float],
-                 instrument: Dict[int, str], compiler: "Compiler"):
+                 instrument: Dict[int, str], group_notes: bool,
+                 max_polyphony: Optional[int], min_volume: float,
+                 compiler: "Compiler"):
         super().__init__(MusicDataType())
         self.midi = midi
         self.listener_str = listener_str
         self.note_offset = note_offset
-        self.chunk_size = chunk_size
         self.override_instrument = instrument
-        self.tracks = [t.copy() for t in midi.tracks]
         # Check MIDI type
         if midi.type != 0 and midi.type != 1:
             raise Error(
@@ -299,16 +305,10 @@ class Music(ConstExprCombined):
                     % midi.type
             )
         # Speed settings
-        self.bpm = 120
         self.mt_per_beat = midi.ticks_per_beat
         self.user_speed = speed
         # Ticking
-        self.mt = 0
-        self.gt = 0.0
-        self.gt_int = 0  # Always == round(self.gt)
-        self.last_gt_int = 0
-        # last_msg_mt: track id to MT when last Message is handled
-        self.last_msg_mt = dict.fromkeys(range(len(midi.tracks)), 0)
+        self.gt_int = 0  # GT of the message being handled
         # Channel info
         self.channel_volume = {}  # channel id to volume (0-15)
         self.channel_instrument = {}  # channel id to instrument id
@@ -329,33 +329,49 @@ class Music(ConstExprCombined):
         self.user_volume = volume
         self.user_channel_volume = dict.fromkeys(range(16), 1.0)
         self.user_channel_volume.update(channel_volume)
-        # Create file
-        self.files = []
-        # file_sep_gt: in which GT we seperate the file
-        self.file_sep_gt = []
-        self.cur_chunk_size = 0  # Commands written in current file
-        self.new_file()  # Initial file
+        self.min_volume = min_volume
+        # Notes: GT to (volume, sound, pitch) of notes in that GT
+        self.notes: Dict[int, List[Tuple[float, str, float]]] = {}
         # Go
-        while not self.is_finished():
-            self.main_loop()
-        GT_LEN = self.gt_int  # Length of music in GT
-        # The last file may be useless
-        if not self.files[-1].has_content():
-            self.files.pop()
-            self.file_sep_gt.pop()
-        # Add file
-        for file in self.files:
-            compiler.add_file(file)
-        self.file_sep_gt.append(GT_LEN + 1)
+        GT_LEN = self.read_messages(midi)  # Length of music in GT
+        # Each GT that has notes gets its own file, and the timer is
+        # looked up in a binary tree of these files, so that only
+        # O(log n) conditions are checked every tick.
+        table = []
+        listener_env = [cmds.ExecuteEnv("as", self.listener_str),
+                        cmds.ExecuteEnv("at", "@s")]
+        for gt in sorted(self.notes):
+            notes = self.notes[gt]
+            if max_polyphony is not None and len(notes) > max_polyphony:
+                # Keep the loudest ones
+                notes.sort(key=lambda note: note[0], reverse=True)
+                del notes[max_polyphony:]
+            playsounds = [
+                "playsound %s @s ~ ~ ~ %.2f %.3f" % (sound, volume, pitch)
+                for volume, sound, pitch in notes
+            ]
+            if group_notes and len(playsounds) > 1:
+                file = cmds.MCFunctionFile()
+                compiler.add_file(file)
+                file.write_debug("# Music notes at game tick %d" % gt)
+                file.extend(playsounds)
+                commands = [cmds.Execute(listener_env,
+                                         runs=cmds.InvokeFunction(file))]
+            else:
+                commands = [cmds.Execute(listener_env, runs=playsound)
+                            for playsound in playsounds]
+            if len(commands) == 1:
+                action = commands[0]
+            else:
+                file = cmds.MCFunctionFile()
+                compiler.add_file(file)
+                file.write_debug("# Music notes at game tick %d" % gt)
+                file.extend(commands)
+                action = cmds.InvokeFunction(file)
+            table.append((gt, gt, action))
         # Loop commands
         loopcmds: CMDLIST_T = [cmds.Comment("# music.Music")]
-        loopcmds.extend(
-            cmds.Execute(
-                [cmds.ExecuteScoreMatch(self.timer.slot, f"{t1}..{t2 - 1}")],
-                runs=cmds.InvokeFunction(self.files[i])
-            )
-            for i, (t1, t2) in enumerate(pairwise(self.file_sep_gt))
-        )
+        loopcmds.extend(compiler.range_dispatch(self.timer.slot, table))
         loopcmds.append(
             cmds.Execute(
                 [cmds.ExecuteScoreMatch(self.timer.slot, f"..{GT_LEN}")],
@@ -394,51 +410,52 @@ class Music(ConstExprCombined):
             commands = [cmds.ScbSetConst(self.timer.slot, GT_LEN + 2)]
             return resultlib.commands(commands)
 
-    def main_loop(self):
-        # Read messages
-        for i, track in enumerate(self.tracks):
-            if not track:
-                continue
-            message = track[0]
-            if message.time > self.mt - self.last_msg_mt[i]:
-                continue
-            # Handle message
+    def gt_per_mt(self, tempo: int) -> float:
+        """Return how many GT there are in 1 MT at `tempo` (microseconds
+        per beat).
+        """
+        # 6E+7 / tempo * mt_per_beat is MT per minute. Divide it by
+        # 1200 to get MT per GT, and multiply it by `user_speed` at last
+        return 1200 * tempo / (6E+7 * self.mt_per_beat * self.user_speed)
+
+    def read_messages(self, midi) -> int:
+        """Handle all messages in `midi` and return length of music in
+        GT.
+        """
+        # Merge tracks into one stream of (absolute MT, track id,
+        # message); the sort is stable so messages at the same MT in
+        # one track keep their order.
+        events = []
+        for i, track in enumerate(midi.tracks):
+            mt = 0
+            for message in track:
+                mt += message.time
+                events.append((mt, i, message))
+        events.sort(key=lambda event: event[:2])
+        # Tempo map: GT of MT `mt` is `seg_gt + (mt - seg_mt) * rate`,
+        # where the segment starts at the last tempo change.
+        seg_mt = 0
+        seg_gt = 0.0
+        rate = self.gt_per_mt(500000)  # 120 BPM by default
+        for mt, _, message in events:
+            self.gt_int = round(seg_gt + (mt - seg_mt) * rate)
             mtype = message.type
             if mtype == "note_on":
                 if message.velocity != 0:
                     self.play_note(message)
             elif mtype == "set_tempo":
-                self.bpm = 6E+7 / message.tempo
+                seg_gt += (mt - seg_mt) * rate
+                seg_mt = mt
+                rate = self.gt_per_mt(message.tempo)
             elif message.is_cc():
                 if message.control == 7:  # Volume
                     self.channel_volume[message.channel] = message.value
             elif mtype == "program_change":
                 self.channel_instrument[message.channel] = message.program
-            # Reset timer
-            self.last_msg_mt[i] = self.mt
-            track.pop(0)
-        # Time increment
-        self.mt += 1
-        # bpm * mt_per_beat is MT per minute. Divide it by 1200 to get MT
-        # per GT, and multiply it by `user_speed` at last
-        self.gt += 1 / (self.bpm * self.mt_per_beat * self.user_speed / 1200)
-        self.gt_int = round(self.gt)
-        # Update last_gt_int
-        if self.gt_int > self.last_gt_int:
-            self.last_gt_int = self.gt_int
-            # New file check
-            if self.cur_chunk_size >= self.chunk_size:
-                self.new_file()
-
-    def new_file(self):
-        self.cur_file = cmds.MCFunctionFile()
-        self.files.append(self.cur_file)
-        self.cur_file.write_debug("# Music loop")
-        self.file_sep_gt.append(self.gt_int)
-        self.cur_chunk_size = 0
-
-    def is_finished(self):
-        return not any(self.tracks)
+        if not events:
+            return 0
+        # The music ends 1 MT after the last message
+        return round(seg_gt + (events[-1][0] + 1 - seg_mt) * rate)
 
     def get_instrument(self, channel: int) -> str:
         """Get MC sound of channel."""
@@ -458,19 +475,11 @@ class Music(ConstExprCombined):
     def play_note(self, message):
         """Play a note according to note_on Message"""
         volume = self.get_volume(message.channel, message.velocity)
-        if volume == 0:
+        if volume == 0 or volume < self.min_volume:
             return
         pitch = self.get_pitch(message.note)
         sound = self.get_instrument(message.channel)
-        self.cur_file.write(cmds.Execute(
-            [cmds.ExecuteScoreMatch(self.timer.slot, str(self.gt_int)),
-             cmds.ExecuteEnv("as", self.listener_str),
-             cmds.ExecuteEnv("at", "@s")],
-            runs=cmds.Cmd(
-                "playsound %s @s ~ ~ ~ %.2f %.3f" % (sound, volume, pitch)
-            )
-        ))
-        self.cur_chunk_size += 1
+        self.notes.setdefault(self.gt_int, []).append((volume, sound, pitch))
 
 def acacia_build(compiler: "Compiler"):
     global mido
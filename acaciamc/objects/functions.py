@@ -60,7 +60,6 @@ from abc import abstractmethod
 from acaciamc.error import *
 from acaciamc.mccmdgen.datatype import DefaultDataType, Storable
 from acaciamc.ast import FuncPortType
-from acaciamc.mccmdgen.mcselector import MCSelector
 from acaciamc.mccmdgen.ctexpr import (
     CTObj, CTObjPtr, CTDataType, CTExpr, CTCallable
 )
@@ -550,46 +549,63 @@ class BoundVirtualMethod(ConstExprCombined, AcaciaCallable):
                     file.write("tag @s add %s" % only_selfvar.tag)
                 file.extend(_call_bm(args, keywords, only_bm))
                 continue
-            # Fallback
+            # Fallback: binary search on the template id of @s
+            # None for implementations that do nothing
+            actions: Dict[int, Optional[cmds.Command]] = {}
             for impl, (_, templates, get_self_var) in self.impls.items():
-                file.write_debug(
-                    "# For %s"
-                    % (", ".join(template.name for template in templates))
-                )
-                sel = MCSelector("s")
-                for template in templates:
-                    sel.scores(compiler.etemplate_id_scb,
-                               f"!{template.runtime_id}")
-                sel_s = sel.to_str()
                 commands = _call_bm(args, keywords, impl)
                 if not commands:
+                    for template in templates:
+                        actions[template.runtime_id] = None
                     continue
                 f = cmds.MCFunctionFile()
                 compiler.add_file(f)
                 f.write_debug("## Helper for virtual method dispatcher")
+                f.write_debug(
+                    "# For %s"
+                    % (", ".join(template.name for template in templates))
+                )
                 f.extend(commands)
                 if get_self_var is None:
-                    file.write(cmds.Execute(
-                        [
-                            cmds.ExecuteCond("entity", sel_s, invert=True),
-                            # Make sure @s is alive:
-                            cmds.ExecuteCond("entity", "@s")
-                        ],
+                    # Make sure @s is alive:
+                    action = cmds.Execute(
+                        [cmds.ExecuteCond("entity", "@s")],
                         runs=cmds.InvokeFunction(f)
-                    ))
+                    )
                 else:
                     self_var = get_self_var()
                     # XXX direct access to TaggedEntity.tag
                     self_tag = self_var.tag
                     file.extend(self_var.clear())
-                    file.write(cmds.Execute(
-                        [cmds.ExecuteCond("entity", sel_s, invert=True)],
-                        runs="tag @s add %s" % self_tag
-                    ))
-                    file.write(cmds.Execute(
+                    f2 = cmds.MCFunctionFile()
+                    compiler.add_file(f2)
+                    f2.write_debug("## Set self for virtual method")
+                    f2.write("tag @s add %s" % self_tag)
+                    f2.write(cmds.Execute(
                         [cmds.ExecuteCond("entity", "@s[tag=%s]" % self_tag)],
                         runs=cmds.InvokeFunction(f)
                     ))
+                    action = cmds.InvokeFunction(f2)
+                for template in templates:
+                    actions[template.runtime_id] = action
+            if not any(actions.values()):
+                continue
+            compiler.mark_dispatcher(file)
+            # Entities here must use a template that has an
+            # implementation, so ids that belong to no implementation
+            # can join any range. Ids of implementations that do
+            # nothing must not run others, so they break ranges.
+            ranges: List[Tuple[int, int, Optional[cmds.Command]]] = []
+            for id_ in sorted(actions):
+                action = actions[id_]
+                if ranges and ranges[-1][2] is action:
+                    ranges[-1] = (ranges[-1][0], id_, action)
+                else:
+                    ranges.append((id_, id_, action))
+            file.extend(compiler.range_dispatch(
+                cmds.ScbSlot("@s", compiler.etemplate_id_scb),
+                [r for r in ranges if r[2] is not None]
+            ))
 
 class ConstructorFunction(AcaciaCallable):
     def call(self, args: ARGS_T, keywords: KEYWORDS_T, compiler) -> CALLRET_T:
@@ -3,6 +3,7 @@
 __all__ = ['ModuleDataType', 'BinaryModule', 'AcaciaModule', 'BuiltModule']
 
 from typing import Dict, Optional
+from types import ModuleType
 import importlib.util
 
 from acaciamc.mccmdgen.expr import *
@@ -34,22 +35,32 @@ class BinaryModule(ConstExprCombined):
     """A binary module that is implemented in Python."""
     cdata_type = ctdt_module
 
-    def __init__(self, path: str):
-        """`path` is path to the binary module Python file."""
+    def __init__(self, path: str, py_module: Optional[ModuleType] = None):
+        """
+        `path` is path to the binary module Python file.
+        `py_module` is the module object of `path` if the file has
+        already been executed before (by another compilation), in which
+        case it is not executed again.
+        """
         super().__init__(ModuleDataType())
         self.path = path
-        # get the module from `path`
-        self.spec = importlib.util.spec_from_file_location(
-            '<acacia module %r>' % path, path
-        )
-        self.py_module = importlib.util.module_from_spec(self.spec)
+        if py_module is None:
+            # get the module from `path`
+            self.spec = importlib.util.spec_from_file_location(
+                '<acacia module %r>' % path, path
+            )
+            self.py_module = importlib.util.module_from_spec(self.spec)
+        else:
+            self.spec = None
+            self.py_module = py_module
 
     def execute(self, compiler) -> CMDLIST_T:
         """
         Execute the code in the binary module Python file.
         Return the commands run by the module during initialization.
         """
-        self.spec.loader.exec_module(self.py_module)
+        if self.spec is not None:
+            self.spec.loader.exec_module(self.py_module)
         # Call `acacia_build`
         # Binary modules should define a function named `acacia_build`,
         # which accepts 1 argument `compiler` and should return either
@@ -3,7 +3,8 @@
 __all__ = ['Parser']
 
 from typing import (
-    Callable, Optional, List, Tuple, NamedTuple, Type, TYPE_CHECKING
+    Callable, Optional, List, Tuple, NamedTuple, Type, Iterator,
+    TYPE_CHECKING
 )
 
 from acaciamc.error import *
@@ -906,13 +907,26 @@ class Parser:
 
     ## Other generators
 
+    def statements(self) -> Iterator[Statement]:
+        """Read statements until END_MARKER one at a time."""
+        while self.current_token.type != TokenType.end_marker:
+            yield self.statement()
+
     def module(self):
         """module := statement* END_MARKER"""
         pos = self.current_pos
-        stmts = []
-        while self.current_token.type != TokenType.end_marker:
-            stmts.append(self.statement())
-        return Module(stmts, **pos)
+        return Module(list(self.statements()), **pos)
+
+    def module_stream(self):
+        """
+        Same as `module`, but the statements are not read until the
+        body of result is iterated over, so that statements can be
+        handled while parsing the rest of the module. The body can only
+        be iterated once, and the tokenizer's source must be kept open
+        until then.
+        """
+        pos = self.current_pos
+        return Module(self.statements(), **pos)
 
     def argument_table(self, allowed_ports: Tuple[FuncPortType],
                        type_required=True):
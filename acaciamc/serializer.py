@@ -0,0 +1,103 @@
+"""
+Compact binary serialization of Acacia syntax trees.
+
+A tree is flattened into nested tuples, lists and dicts of primitive
+values and then stored with `marshal`. Every object (AST node,
+`ModuleMeta` or enum member) becomes a tuple whose first item indexes a
+schema table, which records the class name and field names only once
+per class. Only names defined in `acaciamc.ast` can be loaded.
+"""
+
+__all__ = ["dump_ast", "load_ast", "SerializeError"]
+
+from typing import Dict, List, Tuple, Union
+from enum import Enum
+import marshal
+
+import acaciamc.ast as ast
+
+# Increase this when format changes
+FORMAT = 1
+_PRIMITIVES = frozenset((str, int, float, bool, type(None)))
+
+class SerializeError(Exception):
+    """Data can't be loaded as a syntax tree."""
+    pass
+
+# A schema entry is (class name, field names) for normal objects or
+# (class name, member name) for enum members.
+_SCHEMA_T = Tuple[str, Union[Tuple[str, ...], str]]
+
+def dump_ast(node: ast.AST) -> bytes:
+    """Serialize syntax tree `node`."""
+    schema: List[_SCHEMA_T] = []
+    indexes: Dict[tuple, int] = {}
+
+    def _index(key: tuple, entry: _SCHEMA_T) -> int:
+        i = indexes.get(key)
+        if i is None:
+            i = indexes[key] = len(schema)
+            schema.append(entry)
+        return i
+
+    def _conv(value):
+        tp = type(value)
+        if tp in _PRIMITIVES:
+            return value
+        if tp is list:
+            return [_conv(v) for v in value]
+        if tp is dict:
+            return {k: _conv(v) for k, v in value.items()}
+        if getattr(ast, tp.__name__, None) is not tp:
+            raise SerializeError("can't serialize %r" % value)
+        if isinstance(value, Enum):
+            return (_index((tp, value.name), (tp.__name__, value.name)),)
+        fields = tuple(vars(value))
+        res = [_index((tp, fields), (tp.__name__, fields))]
+        res.extend(_conv(v) for v in vars(value).values())
+        return tuple(res)
+
+    tree = _conv(node)
+    return marshal.dumps((FORMAT, schema, tree))
+
+def load_ast(data: bytes) -> ast.AST:
+    """Load a syntax tree serialized by `dump_ast`."""
+    try:
+        version, schema, tree = marshal.loads(data)
+    except (ValueError, EOFError, TypeError) as err:
+        raise SerializeError(str(err)) from None
+    if version != FORMAT:
+        raise SerializeError("unsupported format %r" % version)
+    # Resolve schema
+    makers = []
+    for name, spec in schema:
+        cls = getattr(ast, name, None)
+        if not isinstance(cls, type):
+            raise SerializeError("unknown class %r" % name)
+        if isinstance(spec, str):
+            makers.append(cls[spec])
+        else:
+            makers.append((cls, spec))
+
+    def _conv(value):
+        tp = type(value)
+        if tp is tuple:
+            maker = makers[value[0]]
+            if type(maker) is not tuple:
+                return maker  # enum member
+            cls, fields = maker
+            obj = cls.__new__(cls)
+            d = obj.__dict__
+            for field, v in zip(fields, value[1:]):
+                d[field] = v if type(v) in _PRIMITIVES else _conv(v)
+            return obj
+        if tp is list:
+            return [v if type(v) in _PRIMITIVES else _conv(v) for v in value]
+        if tp is dict:
+            return {k: _conv(v) for k, v in value.items()}
+        return value
+
+    try:
+        return _conv(tree)
+    except (IndexError, KeyError, TypeError, ValueError) as err:
+        raise SerializeError(str(err)) from None
@@ -5,7 +5,9 @@ __all__  = ['TokenType', 'Token', 'Tokenizer']
 from typing import (
     Union, List, TextIO, Tuple, Dict, Optional, NamedTuple, Any, TYPE_CHECKING
 )
+from collections import deque
 import enum
+import re
 import string
 
 from acaciamc.error import *
@@ -14,7 +16,6 @@ from acaciamc.constants import COLORS, COLORS_NEW, FUNCTION_PATH_CHARS
 if TYPE_CHECKING:
     from acaciamc.tools.versionlib import VERSION_T
 
-HEXDIGITS = frozenset(string.hexdigits)
 UNICODE_ESCAPES = {'x': 2, 'u': 4, 'U': 8}
 FONTS = {
     "reset": "r",
@@ -139,6 +140,62 @@ BRACKETS = {
 }
 RB2LB = {v: k for k, v in BRACKETS.items()}
 
+# Operators and brackets: values of `TokenType` that have 1 or 2
+# characters and don't start with an identifier character
+OPERATORS: Dict[str, TokenType] = {
+    token_type.value: token_type for token_type in TokenType
+    if len(token_type.value) <= 2 and not token_type.value[0].isalnum()
+}
+_OPEN_BRACKETS = frozenset(lb.value for lb in BRACKETS)
+_CLOSE_BRACKETS = frozenset(rb.value for rb in RB2LB)
+_BRACKET_CHARS = _OPEN_BRACKETS | _CLOSE_BRACKETS
+
+# Regular expressions used to read runs of characters at once.
+_SPACES = re.compile(r" +")
+_OPERATOR = re.compile("|".join(
+    # Sort to make sure two-char operators are tried first
+    map(re.escape, sorted(OPERATORS, key=len, reverse=True))
+))
+# A superset of names: `\w` also allows characters like non-ASCII
+# digits that `is_idcontinue` rejects, so non-ASCII names are checked
+# by `_valid_name_len` afterwards.
+_NAME_PATTERN = r"[^\W\d]\w*"
+# Numbers with a base prefix need at least one digit; the bad ones are
+# left for `Tokenizer.handle_number` to report.
+_NUMBER_PATTERN = r"""
+    (?P<based>0[bB][01]+|0[oO][0-7]+|0[xX][0-9A-Fa-f]+)
+  | (?P<float>(?!0[bBoOxX])[0-9]+\.[0-9]+)
+  | (?P<integer>(?!0[bBoOxX])[0-9]+)
+"""
+_NAME = re.compile(_NAME_PATTERN)
+_NUMBER = re.compile(_NUMBER_PATTERN, re.VERBOSE)
+# The common tokens: names, numbers and operators, along with spaces
+# in front of them.
+_FAST_TOKEN = re.compile(r"""
+    [ ]*
+    (?:
+        (?P<name>%s)
+      | %s
+      | (?P<operator>%s)
+    )
+""" % (_NAME_PATTERN, _NUMBER_PATTERN, _OPERATOR.pattern), re.VERBOSE)
+_IDENTIFIER = TokenType.identifier
+_INTEGER = TokenType.integer
+_FLOAT = TokenType.float_
+_NON_ASCII = re.compile(r"[^\x00-\x7f]")
+_BASES = {"b": 2, "B": 2, "o": 8, "O": 8, "x": 16, "X": 16}
+_HEX_DIGITS = {
+    length: re.compile("[0-9A-Fa-f]{0,%d}" % length)
+    for length in UNICODE_ESCAPES.values()
+}
+# Specifiers of a font escape "\#(...)": group 2 is empty if it is not
+# closed on this line.
+_FONT_SPECS = re.compile(r"\(([^)\n]*)(\)?)")
+# Text in commands and strings that needs no special handling
+_COMMAND_TEXT = re.compile(r"[^\\$\n]+")
+_LONG_COMMAND_TEXT = re.compile(r"[^\\$\n*]+")
+_STRING_TEXT = re.compile(r'[^\\$\n"]+')
+
 def is_idstart(c: str) -> bool:
     """Return if given character can start an identifier in Acacia."""
     return c.isalpha() or c == '_'
@@ -147,6 +204,28 @@ def is_idcontinue(c: str) -> bool:
     """Return if given character is valid in an Acacia identifier."""
     return is_idstart(c) or c in string.digits
 
+def _valid_name_len(name: str) -> int:
+    """
+    Return length of the longest prefix of `name` (matched by `_NAME`)
+    that is a valid identifier.
+    """
+    if _NON_ASCII.search(name) is None:
+        return len(name)
+    if not is_idstart(name[0]):
+        return 0
+    for i, c in enumerate(name):
+        if not is_idcontinue(c):
+            return i
+    return len(name)
+
+def _number_value(kind: str, text: str) -> Union[int, float]:
+    """Value of number `text` matched as group `kind` of `_NUMBER`."""
+    if kind == "integer":
+        return int(text)
+    if kind == "float":
+        return float(text)
+    return int(text, _BASES[text[1]])
+
 class Token(NamedTuple):
     type: TokenType
     lineno: int
@@ -236,7 +315,7 @@ class Tokenizer:
         self.current_lineno = 0
         self.current_col = 0
         self.position = 0  # string pointer
-        self.buffer_tokens: List[Token] = []
+        self.buffer_tokens: "deque[Token]" = deque()
         self.bracket_stack: List[_BracketFrame] = []
         self.indent_record: List[int] = [0]
         self.indent_len: int = 1  # always = len(self.indent_record)
@@ -270,6 +349,32 @@ class Tokenizer:
             self.position += 1
             self.current_col += 1
 
+    def goto(self, index: int):
+        """
+        Make character at `index` of current line the current char.
+        This is the same as calling `forward` until we get there.
+        """
+        if index >= self.line_len:
+            self.current_char = None
+            self.position = self.line_len
+            self.current_col = self.line_len + 1
+        else:
+            self.current_char = self.current_line[index]
+            self.position = self.current_col = index + 1
+
+    def match(self, pattern: "re.Pattern") -> Optional[str]:
+        """
+        Match `pattern` from current char. Return the matched string
+        and skip it, or return None if there is no match.
+        """
+        if self.current_char is None:
+            return None
+        m = pattern.match(self.current_line, self.position - 1)
+        if m is None:
+            return None
+        self.goto(m.end())
+        return m.group()
+
     def peek(self, offset=0):
         """Peek the following char without pushing pointer."""
         pos = self.position + offset
@@ -280,8 +385,8 @@ class Tokenizer:
     def get_next_token(self):
         """Get the next token."""
         while not self.buffer_tokens:
-            self.buffer_tokens = self.parse_line()
-        return self.buffer_tokens.pop(0)
+            self.buffer_tokens.extend(self.parse_line())
+        return self.buffer_tokens.popleft()
 
     def is_in_bracket(self) -> bool:
         return bool(self.bracket_stack)
@@ -303,10 +408,8 @@ class Tokenizer:
             # Generate indent token if this is not a continued line
             # (start of a new logical line).
             self.has_content = False
-            prespaces = 0
-            while self.current_char == ' ':
-                prespaces += 1
-                self.forward()
+            spaces = self.match(_SPACES)
+            prespaces = 0 if spaces is None else len(spaces)
         else:
             prespaces = -1
             if self.continued_comment:
@@ -323,13 +426,19 @@ class Tokenizer:
                     res.extend(self.handle_command())
             if self.string_stack and not self.in_string_fexpr:
                 res.extend(self.handle_string())
+            # read common tokens quickly
+            if (self.current_char is not None
+                and not self.last_is_interface
+                and self.handle_fast_tokens(res)):
+                continue
             # skip spaces
             self.skip_spaces()
+            c = self.current_char
             # check end of line
-            if self.current_char in ("\n", "\\", None):
+            if c in ("\n", "\\", None):
                 break
             # comment
-            if self.current_char == "#":
+            if c == "#":
                 if self.peek() == "*":
                     self.forward()
                     self.forward()
@@ -343,7 +452,7 @@ class Tokenizer:
             # start
             ## path after `interface` keyword
             if self.last_is_interface:
-                if self.current_char == '"':
+                if c == '"':
                     # Quoted path
                     self.enter_string()
                     self.forward()
@@ -353,73 +462,36 @@ class Tokenizer:
                 self.last_is_interface = False
                 continue
             ## special tokens
-            ok = True
-            if self.current_char in string.digits:
+            if c in string.digits:
                 res.append(self.handle_number())
-            elif is_idstart(self.current_char):
+                continue
+            if is_idstart(c):
                 id_token = self.handle_name()
                 res.append(id_token)
                 # Special case: `interface` keyword, since after it goes
                 # a path.
                 if id_token.type is TokenType.interface:
                     self.last_is_interface = True
-            elif self.current_char == '/' and not (self.has_content or res):
+                continue
+            if c == '/' and not (self.has_content or res):
                 # Only read when "/" is first token of this logical line.
                 self.inside_command = _CommandManager(self)
                 self.forward()  # skip "/"
                 if self.current_char == '*':
                     self.continued_command = True
                     self.forward()  # skip "*"
-            elif self.current_char == '"':
+                continue
+            if c == '"':
                 self.forward()  # skip '"'
                 self.enter_string()
-            else:
-                ok = False
-            if ok:
                 continue
-            ## try two-char token
-            peek = self.peek()
-            if peek is not None:
-                twochars = self.current_char + peek
-                try:
-                    token_type = TokenType(twochars)
-                except ValueError:
-                    pass
-                else:
-                    # It is indeed a two-char token!
-                    res.append(self.gen_token(token_type))
-                    self.forward()
-                    self.forward()
-                    continue
-            ## try one-char token
-            try:
-                token_type = TokenType(self.current_char)
-            except ValueError:
+            ## operators and brackets (two-char ones are tried first)
+            m = _OPERATOR.match(self.current_line, self.position - 1)
+            if m is None:
                 # We've run out of possibilities.
-                self.error(ErrorType.INVALID_CHAR, char=self.current_char)
-            else:
-                if token_type in BRACKETS:
-                    self.bracket_stack.append(_BracketFrame(
-                        token_type,
-                        (self.current_lineno, self.current_col)
-                    ))
-                elif token_type in RB2LB:
-                    if not self.bracket_stack:
-                        self.error(ErrorType.UNMATCHED_BRACKET,
-                                   char=self.current_char)
-                    expect = RB2LB[token_type]
-                    got_f = self.bracket_stack.pop()
-                    got = got_f.type
-                    if got is not expect:
-                        self.error(ErrorType.UNMATCHED_BRACKET_PAIR,
-                                   open=got.value, close=token_type.value)
-                    if got is TokenType.lbrace:
-                        if got_f.cmd_fexpr:
-                            self.in_command_fexpr = False
-                        elif got_f.str_fexpr:
-                            self.in_string_fexpr = False
-                res.append(self.gen_token(token_type))
-                self.forward()
+                self.error(ErrorType.INVALID_CHAR, char=c)
+            res.append(self.operator_token(m.group()))
+            self.goto(m.end())
         # Now self.current_char is either '\n', '\\' or None (EOF)
         if (
             # ${} in single line command can't use implicit line continuation.
@@ -482,15 +554,107 @@ class Tokenizer:
             *args, **kwargs
         )
 
+    def handle_fast_tokens(self, res: List[Token]) -> bool:
+        """
+        Read as many tokens as possible with `_FAST_TOKEN` and append
+        them to `res`. Stop before anything else, which is then handled
+        by `parse_line` as usual. Return if any token is read.
+        """
+        line = self.current_line
+        ln = self.current_lineno
+        append = res.append
+        pos = begin = self.position - 1
+        match = _FAST_TOKEN.match
+        while True:
+            m = match(line, pos)
+            if m is None:
+                break
+            kind = m.lastgroup
+            start, end = m.span(kind)
+            text = m.group(kind)
+            if kind == "name":
+                length = _valid_name_len(text)
+                if length != len(text):
+                    if not length:
+                        # Invalid character, reported by `parse_line`
+                        pos = start
+                        break
+                    text = text[:length]
+                    end = start + length
+                token_type = KEYWORDS.get(text)
+                if token_type is None:
+                    append(Token(_IDENTIFIER, ln, start + 1, text))
+                else:
+                    append(Token(token_type, ln, start + 1))
+                    if token_type is TokenType.interface:
+                        # A path goes after `interface` keyword
+                        self.last_is_interface = True
+                        pos = end
+                        break
+            elif kind == "operator":
+                # "/" is start of a command if it is the first token of
+                # this logical line
+                if text[0] == "/" and not (self.has_content or res):
+                    break
+                if text in _BRACKET_CHARS:
+                    self.goto(start)
+                    append(self.operator_token(text))
+                    if text in _CLOSE_BRACKETS:
+                        # This might be end of a formatted expression
+                        pos = end
+                        break
+                else:
+                    append(Token(OPERATORS[text], ln, start + 1))
+            elif kind == "integer":
+                append(Token(_INTEGER, ln, start + 1, int(text)))
+            else:
+                append(Token(
+                    _FLOAT if kind == "float" else _INTEGER,
+                    ln, start + 1, _number_value(kind, text)
+                ))
+            pos = end
+        self.goto(pos)
+        return pos != begin
+
+    def operator_token(self, op: str) -> Token:
+        """
+        Generate token of operator or bracket `op` at current pos and
+        check brackets.
+        """
+        token_type = OPERATORS[op]
+        if op in _OPEN_BRACKETS:
+            self.bracket_stack.append(_BracketFrame(
+                token_type,
+                (self.current_lineno, self.current_col)
+            ))
+        elif op in _CLOSE_BRACKETS:
+            if not self.bracket_stack:
+                self.error(ErrorType.UNMATCHED_BRACKET, char=op)
+            expect = RB2LB[token_type]
+            got_f = self.bracket_stack.pop()
+            got = got_f.type
+            if got is not expect:
+                self.error(ErrorType.UNMATCHED_BRACKET_PAIR,
+                           open=got.value, close=token_type.value)
+            if got is TokenType.lbrace:
+                if got_f.cmd_fexpr:
+                    self.in_command_fexpr = False
+                elif got_f.str_fexpr:
+                    self.in_string_fexpr = False
+        return Token(token_type, self.current_lineno, self.current_col)
+
     def skip_spaces(self):
         """Skip white spaces."""
-        while self.current_char == ' ':
-            self.forward()
+        if self.current_char == ' ':
+            self.match(_SPACES)
 
     def skip_comment(self):
         """Skip a single-line # comment."""
-        while self.current_char is not None and self.current_char != '\n':
-            self.forward()
+        # "\n" can only be the last char of a line.
+        if self.current_line.endswith('\n'):
+            self.goto(self.line_len - 1)
+        else:
+            self.goto(self.line_len)
 
     def enter_string(self):
         """Enter a string literal."""
@@ -498,17 +662,15 @@ class Tokenizer:
         self.in_string_fexpr = False
 
     def handle_long_comment(self):
-        # we want to leave current_char on next char after "#",
-        # so use previous_char
-        previous_char = ''
-        while not (previous_char == '*' and self.current_char == '#'):
-            if self.current_char in ("\n", None):
-                self.continued_comment = True
+        # we want to leave current_char on next char after "#"
+        if self.current_char is not None:
+            end = self.current_line.find('*#', self.position - 1)
+            if end != -1:
+                self.goto(end + 2)
+                self.continued_comment = False
                 return
-            previous_char = self.current_char
-            self.forward()
-        self.forward()  # skip char "#"
-        self.continued_comment = False
+        self.skip_comment()
+        self.continued_comment = True
 
     def handle_logical_newline(self):
         """Generate a logical NEWLINE token and do checks."""
@@ -535,64 +697,27 @@ class Tokenizer:
             self.error(ErrorType.INVALID_DEDENT)
         return tokens
 
-    @staticmethod
-    def _isdecimal(char: Union[str, None]):
-        return char is not None and char in string.digits
-
     def handle_number(self):
         """Read an INTEGER or a FLOAT token."""
-        res = []
         ln, col = self.current_lineno, self.current_col
-        ## decide base
-        base = 10
-        peek = self.peek()
-        if self.current_char == '0' and peek is not None:
-            peek = peek.upper()
-            if peek in "BOX":
-                if peek == 'B':
-                    base = 2
-                elif peek == 'O':
-                    base = 8
-                elif peek == 'X':
-                    base = 16
-                # skip 2 chars ("0x" "0b" "0o")
-                self.forward()
-                self.forward()
-        ## read
-        valid_chars = '0123456789ABCDEF'[:base]
-        while ((self.current_char is not None)
-               and (self.current_char.upper() in valid_chars)):
-            res.append(self.current_char)
-            self.forward()
-        ## convert string to number
-        if (self.current_char == "."
-            and base == 10
-            and self._isdecimal(self.peek())
-        ):  # float
-            self.forward()
-            res.append(".")
-            while self._isdecimal(self.current_char):
-                res.append(self.current_char)
-                self.forward()
-            value = float(''.join(res))
-            return Token(TokenType.float_, value=value, lineno=ln, col=col)
-        else:  # integer
-            if not res:
-                self.error(ErrorType.INTEGER_REQUIRED, base=base)
-            value = int(''.join(res), base=base)
-            return Token(TokenType.integer, value=value, lineno=ln, col=col)
+        m = _NUMBER.match(self.current_line, self.position - 1)
+        if m is None:
+            # A base prefix that is not followed by any digit
+            base = _BASES[self.peek()]
+            self.goto(self.position + 1)  # skip "0x" "0b" "0o"
+            self.error(ErrorType.INTEGER_REQUIRED, base=base)
+        self.goto(m.end())
+        kind = m.lastgroup
+        token_type = _FLOAT if kind == "float" else _INTEGER
+        return Token(token_type, value=_number_value(kind, m.group()),
+                     lineno=ln, col=col)
 
     def handle_name(self):
         """Read a keyword or an IDENTIFIER token."""
-        chars = []
         ln, col = self.current_lineno, self.current_col
-        while (
-            self.current_char is not None
-            and is_idcontinue(self.current_char)
-        ):
-            chars.append(self.current_char)
-            self.forward()
-        name = ''.join(chars)
+        m = _NAME.match(self.current_line, self.position - 1)
+        name = m.group()[:_valid_name_len(m.group())]
+        self.goto(m.start() + len(name))
         token_type = KEYWORDS.get(name)
         if token_type is None:  # IDENTIFIER
             return Token(TokenType.identifier, value=name, lineno=ln, col=col)
@@ -627,54 +752,67 @@ class Tokenizer:
             if self.current_char != '(':
                 return '\xA7'
             start_ln, start_col = self.current_lineno, self.current_col
+            m = _FONT_SPECS.match(self.current_line, self.position - 1)
+            specs = m.group(1).split(',')
+            if not m.group(2):
+                # Fonts before the last "," are still checked first
+                specs.pop()
             res: List[str] = []
-            cur_spec: List[str] = []
-            self.forward()  # skip '('
-            while True:
-                if self.current_char is None or self.current_char == '\n':
-                    self.error(ErrorType.UNCLOSED_FONT,
+            for spec in specs:
+                font = spec.strip()
+                ch = self._font2char(font)
+                if ch is None:
+                    self.error(ErrorType.INVALID_FONT, font=font,
                                lineno=start_ln, col=start_col)
-                if self.current_char in (',', ')'):
-                    font = ''.join(cur_spec).strip()
-                    cur_spec.clear()
-                    ch = self._font2char(font)
-                    if ch is None:
-                        self.error(ErrorType.INVALID_FONT, font=font,
-                                   lineno=start_ln, col=start_col)
-                    res.append(f"\xA7{ch}")
-                    if self.current_char == ')':
-                        break
-                else:
-                    cur_spec.append(self.current_char)
-                self.forward()
-            self.forward()  # skip ')'
+                res.append(f"\xA7{ch}")
+            if not m.group(2):
+                self.error(ErrorType.UNCLOSED_FONT,
+                           lineno=start_ln, col=start_col)
+            self.goto(m.end())
             return ''.join(res)
         ## NOTE '\n' should be passed directly to MC
         ## because MC use '\n' escape too
         elif second in UNICODE_ESCAPES:  # unicode number
-            def _err():
+            length = UNICODE_ESCAPES[second]
+            m = _HEX_DIGITS[length].match(self.current_line, self.position)
+            self.goto(m.end())
+            if m.end() - m.start() < length:
                 self.error(ErrorType.INVALID_UNICODE_ESCAPE,
                            escape_char=second)
-            self.forward()  # skip '\\'
-            code = []
-            length = UNICODE_ESCAPES[second]
-            for _ in range(length):
-                if self.current_char not in HEXDIGITS:
-                    _err()
-                code.append(self.current_char)
-                self.forward()
-            unicode = int(''.join(code), base=16)
+            unicode = int(m.group(), base=16)
             if unicode >= 0x110000:
-                _err()
+                self.error(ErrorType.INVALID_UNICODE_ESCAPE,
+                           escape_char=second)
             return chr(unicode)
         # when escape can't be recognized, just return "\\"
         # and the `second` char will be handled later
         return first  # (here first == '\\')
 
+    def _read_plain_text(self, mgr: _FormattedStrManager,
+                         pattern: "re.Pattern") -> bool:
+        """
+        Helper for reading text in string and command. Read as many
+        characters that need no special handling as possible, according
+        to `pattern`. Return if anything is read.
+        """
+        if self.current_char is None:
+            return False
+        m = pattern.match(self.current_line, self.position - 1)
+        if m is None:
+            return False
+        # Position of text is taken after reading first char, which is
+        # consistent with `_fexpr_unit`.
+        self.goto(m.start() + 1)
+        mgr.add_text(m.group())
+        self.goto(m.end())
+        return True
+
     def handle_string(self) -> List[Token]:
         """Help read a string literal."""
         mgr = self.string_stack[-1]
         while self.current_char != '"':
+            if self._read_plain_text(mgr, _STRING_TEXT):
+                continue
             # check None and \n
             if (self.current_char is None) or (self.current_char == '\n'):
                 self.error(ErrorType.UNCLOSED_QUOTE,
@@ -731,6 +869,8 @@ class Tokenizer:
         """Help read a multi-line /*...*/ command. Return the tokens."""
         mgr = self.inside_command
         while not (self.current_char == '*' and self.peek() == '/'):
+            if self._read_plain_text(mgr, _LONG_COMMAND_TEXT):
+                continue
             # check whether we reach end of line
             if self.current_char in ("\n", None):
                 # replace "\n" with " " (space)
@@ -750,6 +890,8 @@ class Tokenizer:
         """Help read a single line command. Return the tokens."""
         mgr = self.inside_command
         while self.current_char is not None and self.current_char != '\n':
+            if self._read_plain_text(mgr, _COMMAND_TEXT):
+                continue
             if self._fexpr_unit(mgr, is_cmd=True):
                 break
         else:
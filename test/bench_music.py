@@ -0,0 +1,69 @@
+# Measure how long `music.Music` takes to convert a large MIDI file
+# A synthetic MIDI with several tracks, a high resolution and tempo
+# changes is generated, then a program that uses it is compiled.
+# Usage: python bench_music.py [MINUTES]
+# NOTE Python package `mido` is required.
+
+# Add `acaciamc` directory to path
+import os
+import sys
+sys.path.append(os.path.realpath(
+    os.path.join(__file__, os.pardir, os.pardir)
+))
+
+import random
+import tempfile
+import time
+
+import mido
+
+from acaciamc.compiler import Compiler, Config
+
+TRACKS = 8
+TICKS_PER_BEAT = 960
+BPM = 120
+NOTES_PER_BEAT = 2  # in each track
+
+def make_midi(path: str, minutes: float):
+    rng = random.Random(0)
+    midi = mido.MidiFile(type=1, ticks_per_beat=TICKS_PER_BEAT)
+    beats = int(minutes * BPM)
+    step = TICKS_PER_BEAT // NOTES_PER_BEAT
+    for i in range(TRACKS):
+        track = mido.MidiTrack()
+        midi.tracks.append(track)
+        channel = i % 16
+        track.append(mido.Message("program_change", channel=channel,
+                                  program=rng.randrange(128)))
+        for beat in range(beats * NOTES_PER_BEAT):
+            if i == 0 and beat % 64 == 0:
+                tempo = mido.bpm2tempo(BPM + rng.randrange(-20, 20))
+                track.append(mido.MetaMessage("set_tempo", tempo=tempo))
+            note = rng.randrange(40, 90)
+            track.append(mido.Message("note_on", channel=channel,
+                                      note=note, velocity=80))
+            track.append(mido.Message("note_off", channel=channel,
+                                      note=note, velocity=0, time=step))
+    midi.save(path)
+    return sum(len(track) for track in midi.tracks)
+
+def main():
+    minutes = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    with tempfile.TemporaryDirectory() as tmp:
+        midi_path = os.path.join(tmp, "bench.mid")
+        messages = make_midi(midi_path, minutes)
+        main_path = os.path.join(tmp, "main.aca")
+        with open(main_path, "w", encoding="utf-8") as f:
+            f.write("import music\n")
+            f.write('const m = music.Music("%s")\n'
+                    % midi_path.replace(os.sep, "/"))
+            f.write("m.play()\n")
+        start = time.perf_counter()
+        Compiler(main_path, Config(optimizer=False))
+        elapsed = time.perf_counter() - start
+    print("MIDI: %.1f minutes, %d tracks, %d messages"
+          % (minutes, TRACKS, messages))
+    print("compile: %.3fs" % elapsed)
+
+if __name__ == "__main__":
+    main()
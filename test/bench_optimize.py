@@ -0,0 +1,100 @@
+# Measure how optimizer time grows with the number of commands
+# A synthetic pack of small functions that call each other (like the
+# output of a big program) is optimized at several sizes; time per
+# command should stay about the same if optimizer scales linearly.
+# Usage: python bench_optimize.py [COMMANDS...]
+
+# Add `acaciamc` directory to path
+import os
+import sys
+sys.path.append(os.path.realpath(
+    os.path.join(__file__, os.pardir, os.pardir)
+))
+
+import random
+import time
+
+from acaciamc.mccmdgen import optimizer, cmds
+
+SIZES = (5000, 10000, 20000, 40000)
+FILE_SIZE = 10  # commands in each function
+SLOTS = 40  # scoreboard slots used by each group of functions
+
+class BenchOpt(optimizer.Optimizer):
+    max_inline_file_size = 20
+
+    def __init__(self):
+        super().__init__("bench")
+        self.main = cmds.MCFunctionFile("main")
+        self.add_file(self.main)
+
+    def entry_files(self):
+        return [self.main]
+
+    def add_lib(self, file):
+        file.set_path("lib/extra%d" % len(self.files))
+        self.add_file(file)
+
+def make_pack(size: int) -> BenchOpt:
+    rng = random.Random(size)
+    opt = BenchOpt()
+    files = []
+    for i in range(size // FILE_SIZE):
+        file = cmds.MCFunctionFile("lib/f%d" % i)
+        opt.add_file(file)
+        files.append(file)
+    slots = []
+    for i, file in enumerate(files):
+        if i % 100 == 0:
+            # Each group of functions works on its own variables
+            slots = [opt.allocate() for _ in range(SLOTS)]
+        for _ in range(FILE_SIZE - 2):
+            a, b = rng.sample(slots, 2)
+            kind = rng.randrange(6)
+            if kind == 0:
+                file.write(cmds.ScbSetConst(a, rng.randrange(10)))
+            elif kind == 1:
+                file.write(cmds.ScbAddConst(a, rng.randrange(1, 10)))
+            elif kind == 2:
+                file.write(cmds.ScbOperation(cmds.ScbOp.ADD_EQ, a, b))
+            elif kind == 3:
+                file.write(cmds.ScbOperation(cmds.ScbOp.ASSIGN, a, b))
+            elif kind == 4:
+                file.write(cmds.Execute(
+                    [cmds.ExecuteEnv("as", "@a"),
+                     cmds.ExecuteScoreMatch(a, "1..")],
+                    cmds.Cmd("say %d" % i)
+                ))
+            else:
+                file.write(cmds.RawtextOutput(
+                    "tellraw @a", cmds.Rawtext([cmds.RawtextScore(a)])
+                ))
+        # Call some functions after this one, a few of them often
+        for _ in range(2):
+            j = rng.randrange(i + 1, len(files) + 10)
+            if j >= len(files):
+                continue
+            if rng.randrange(4) == 0:
+                j = min(i + 1, len(files) - 1)
+            file.write(cmds.Execute(
+                [cmds.ExecuteScoreMatch(rng.choice(slots), "0")],
+                cmds.InvokeFunction(files[j])
+            ))
+    for file in files[::50]:
+        opt.main.write(cmds.InvokeFunction(file))
+    return opt
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print("%10s %10s %12s" % ("commands", "time(s)", "us/command"))
+    for size in sizes:
+        opt = make_pack(size)
+        count = sum(file.cmd_length() for file in opt.files)
+        start = time.perf_counter()
+        opt.optimize()
+        elapsed = time.perf_counter() - start
+        print("%10d %10.3f %12.1f" % (count, elapsed,
+                                      elapsed / count * 1e6))
+
+if __name__ == "__main__":
+    main()
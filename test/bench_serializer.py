@@ -0,0 +1,37 @@
+# Compare loading a serialized syntax tree with parsing the source
+
+# Add `acaciamc` directory to path
+import os
+import sys
+sys.path.append(os.path.realpath(
+    os.path.join(__file__, os.pardir, os.pardir)
+))
+
+import io
+import timeit
+
+from acaciamc.tokenizer import Tokenizer
+from acaciamc.parser import Parser
+from acaciamc.serializer import dump_ast, load_ast
+
+MC_VERSION = (1, 20, 20)
+REPEAT = 50
+SOURCE = os.path.realpath(
+    os.path.join(__file__, os.pardir, "demo", "tetris.aca")
+)
+
+def parse(src: str):
+    return Parser(Tokenizer(io.StringIO(src), MC_VERSION)).module()
+
+with open(SOURCE, "r", encoding="utf-8") as f:
+    src = f.read()
+data = dump_ast(parse(src))
+assert dump_ast(load_ast(data)) == data, "round trip changed the tree"
+
+t_parse = min(timeit.repeat(lambda: parse(src), number=REPEAT, repeat=3))
+t_load = min(timeit.repeat(lambda: load_ast(data), number=REPEAT, repeat=3))
+print("source: %s (%d bytes)" % (SOURCE, len(src)))
+print("serialized tree: %d bytes" % len(data))
+print("parse: %.3fms" % (t_parse / REPEAT * 1000))
+print("load:  %.3fms" % (t_load / REPEAT * 1000))
+print("speedup: %.1fx" % (t_parse / t_load))
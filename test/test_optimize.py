@@ -13,6 +13,10 @@ class MyOpt(optimizer.Optimizer):
 
     max_inline_file_size = 30
 
+    def add_lib(self, file):
+        file.set_path("test/lib%d" % len(self.files))
+        self.add_file(file)
+
     def dump(self):
         return ('\n\n'.join(
             str(file) + '\n' + file.to_str(debugging=True)
@@ -0,0 +1,373 @@
+# Check that optimizer does not change behavior of programs
+# Compile Acacia programs with and without optimizer, run both outputs
+# with a small mcfunction interpreter and compare what they do.
+# Only scoreboard commands, /execute and /function are really
+# executed; every other command is recorded (with scores in rawtext
+# resolved) and the records of two outputs must be the same.
+# Entities and blocks are not simulated: /execute conditions on them
+# get a fixed pseudo-random result, and environment subcommands (like
+# "as" and "at") just run the command once.
+# Scores that players can see (all but those the compiler allocated)
+# are recorded at the end too.
+# Small programs in `CASES` are also run, and what they do must be
+# exactly what is expected.
+# Usage: python test_semantics.py [FILES...]
+# FILES default to the demos and brief.aca (and `CASES` are run).
+
+# Add `acaciamc` directory to path
+import os
+import sys
+ROOT = os.path.realpath(os.path.join(__file__, os.pardir, os.pardir))
+sys.path.append(ROOT)
+
+import glob
+import json
+import random
+import re
+import tempfile
+import zlib
+from typing import Dict, List, Tuple
+
+from acaciamc.compiler import Compiler, Config
+from acaciamc.objects.integer import c_int_div, remainder
+
+TICKS = 20  # how many ticks to simulate
+MAX_RECORDS = 3000  # stop when this many commands are recorded
+MAX_STEPS = 2000000  # stop when this many commands are executed
+MAX_DEPTH = 20000  # stop when function calls nest this deep
+EXECUTE_ENV = {
+    # subcommand -> number of arguments
+    "as": 1, "at": 1, "align": 1, "anchored": 1, "in": 1,
+}
+_TOKEN = re.compile(r'"(?:\\.|[^"\\])*"|\S+')
+
+# (name, source, /say and fake player score records after "# main")
+CASES = [
+    (
+        "jump table while called functions use temporary scores",
+        """
+x := 0
+def f():
+    g := (x + 1) * (x + 2)
+if x == 0:
+    f()
+    /say zero
+elif x == 1:
+    /say one
+elif x == 2:
+    /say two
+else:
+    /say other
+""",
+        ["say zero"]
+    ),
+    (
+        "scores written by users are kept",
+        """
+x := 2
+def f():
+    scb("p", "acacia1") = x + 1
+    scb("q", "acacia1") = scb("p", "acacia1") * 3
+    scb("p", "acacia1") = x
+f()
+f()
+""",
+        ["score p acacia1 = 2", "score q acacia1 = 9"]
+    ),
+    (
+        # Template ids: A is 3, B is 4 and C is 5
+        "virtual method overridden by an empty one between two ids",
+        """
+entity A:
+    new():
+        new(type="armor_stand", pos=Pos(0, 0, 0))
+    virtual inline def f():
+        /say body
+entity B extends A:
+    override inline def f():
+        pass
+entity C extends A:
+    pass
+e := A()
+/scoreboard players set @s acacia2 4
+e.f()
+/say after B
+/scoreboard players set @s acacia2 5
+e.f()
+""",
+        ["say after B", "say body"]
+    ),
+]
+
+class Stop(Exception):
+    pass
+
+def tokenize(cmd: str) -> List[str]:
+    return _TOKEN.findall(cmd)
+
+def unquote(s: str) -> str:
+    if s.startswith('"'):
+        return re.sub(r'\\(.)', r'\1', s[1:-1])
+    return s
+
+def in_range(value: int, range_: str) -> bool:
+    if range_.startswith("!"):
+        return not in_range(value, range_[1:])
+    if ".." in range_:
+        lo, hi = range_.split("..")
+        return ((not lo or value >= int(lo))
+                and (not hi or value <= int(hi)))
+    return value == int(range_)
+
+def pseudo_condition(text: str) -> bool:
+    return zlib.crc32(text.encode("utf-8")) % 2 == 0
+
+class Interpreter:
+    def __init__(self, files: Dict[str, str]):
+        self.functions: Dict[str, List[str]] = {}
+        for path, content in files.items():
+            if path.endswith(".mcfunction"):
+                self.functions[path[:-len(".mcfunction")]] = [
+                    line for line in content.splitlines()
+                    if line and not line.startswith("#")
+                ]
+        self.scores: Dict[Tuple[str, str], int] = {}
+        self.records: List[str] = []
+        self.steps = 0
+        self.depth = 0
+        self.rng = random.Random(0)
+
+    def record(self, text: str):
+        self.records.append(text)
+        if len(self.records) >= MAX_RECORDS:
+            raise Stop
+
+    def get(self, tokens: List[str]) -> int:
+        return self.scores.get((unquote(tokens[0]), unquote(tokens[1])), 0)
+
+    def set(self, tokens: List[str], value: int):
+        # Scores are 32-bit integers
+        value = (value + 2**31) % 2**32 - 2**31
+        self.scores[(unquote(tokens[0]), unquote(tokens[1]))] = value
+
+    def call(self, path: str):
+        self.depth += 1
+        if self.depth >= MAX_DEPTH:
+            raise Stop
+        for command in self.functions[path]:
+            self.run(command)
+        self.depth -= 1
+
+    def run(self, cmd: str):
+        self.steps += 1
+        if self.steps >= MAX_STEPS:
+            raise Stop
+        tokens = tokenize(cmd)
+        head = tokens[0]
+        if head == "function":
+            self.call(tokens[1])
+        elif head == "execute":
+            self.execute(tokens[1:])
+        elif head == "scoreboard" and tokens[1] == "players":
+            self.scoreboard(tokens[2:])
+        elif head in ("tellraw", "titleraw") and cmd.endswith("}"):
+            prefix = cmd[:cmd.index("{")]
+            raw = json.loads(cmd[len(prefix):])
+            self.record(prefix + json.dumps(self.resolve(raw)))
+        elif head != "scoreboard":
+            self.record(cmd)
+
+    def resolve(self, raw):
+        """Replace score components in rawtext JSON with values."""
+        if isinstance(raw, list):
+            return [self.resolve(x) for x in raw]
+        if isinstance(raw, dict):
+            if "score" in raw:
+                score = raw["score"]
+                return self.scores.get((score["name"], score["objective"]),
+                                       0)
+            return {k: self.resolve(v) for k, v in raw.items()}
+        return raw
+
+    def execute(self, tokens: List[str]):
+        i = 0
+        while tokens[i] != "run":
+            sub = tokens[i]
+            if sub in ("if", "unless"):
+                expect = sub == "if"
+                kind = tokens[i + 1]
+                if kind == "score":
+                    value = self.get(tokens[i + 2:i + 4])
+                    op = tokens[i + 4]
+                    if op == "matches":
+                        ok = in_range(value, tokens[i + 5])
+                        i += 6
+                    else:
+                        other = self.get(tokens[i + 5:i + 7])
+                        ok = {
+                            "=": value == other, "<": value < other,
+                            ">": value > other, "<=": value <= other,
+                            ">=": value >= other
+                        }[op]
+                        i += 7
+                else:
+                    # Entity or block conditions
+                    j = i + 2
+                    while tokens[j] not in ("if", "unless", "run") \
+                            and tokens[j] not in EXECUTE_ENV \
+                            and tokens[j] not in ("positioned", "facing",
+                                                  "rotated"):
+                        j += 1
+                    ok = pseudo_condition(" ".join(tokens[i + 1:j]))
+                    i = j
+                if ok != expect:
+                    return
+            elif sub in EXECUTE_ENV:
+                i += 1 + EXECUTE_ENV[sub]
+            elif sub in ("positioned", "rotated", "facing"):
+                if tokens[i + 1] == "as":
+                    i += 3
+                elif sub == "facing" and tokens[i + 1] == "entity":
+                    i += 4
+                elif sub == "rotated":
+                    i += 3
+                else:
+                    i += 4
+            else:
+                raise ValueError("unknown execute subcommand %r" % sub)
+        self.run(" ".join(tokens[i + 1:]))
+
+    def scoreboard(self, tokens: List[str]):
+        action = tokens[0]
+        target = tokens[1:3]
+        if action == "set":
+            self.set(target, int(tokens[3]))
+        elif action == "add":
+            self.set(target, self.get(target) + int(tokens[3]))
+        elif action == "remove":
+            self.set(target, self.get(target) - int(tokens[3]))
+        elif action == "random":
+            self.set(target, self.rng.randint(int(tokens[3]),
+                                              int(tokens[4])))
+        elif action == "operation":
+            op = tokens[3]
+            source = tokens[4:6]
+            a, b = self.get(target), self.get(source)
+            if op == "=":
+                self.set(target, b)
+            elif op == "+=":
+                self.set(target, a + b)
+            elif op == "-=":
+                self.set(target, a - b)
+            elif op == "*=":
+                self.set(target, a * b)
+            elif op == "/=":
+                if b != 0:
+                    self.set(target, c_int_div(a, b))
+            elif op == "%=":
+                if b != 0:
+                    self.set(target, remainder(a, b))
+            elif op == "<":
+                self.set(target, min(a, b))
+            elif op == ">":
+                self.set(target, max(a, b))
+            elif op == "><":
+                self.set(target, b)
+                self.set(source, a)
+            else:
+                raise ValueError("unknown operation %r" % op)
+        else:
+            self.record("scoreboard players " + " ".join(tokens))
+
+def simulate(files: Dict[str, str], cfg: Config) -> List[str]:
+    """Run main, every interface and ticks; return records."""
+    interp = Interpreter(files)
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), MAX_DEPTH * 10))
+    internal = cfg.internal_folder + "/"
+    try:
+        interp.record("# main")
+        interp.call(cfg.main_file)
+        for path in sorted(interp.functions):
+            if path != cfg.main_file and not path.startswith(internal):
+                interp.record("# interface " + path)
+                interp.call(path)
+        tick = internal + "tick"
+        if tick in interp.functions:
+            for i in range(TICKS):
+                interp.record("# tick %d" % i)
+                interp.call(tick)
+    except Stop:
+        interp.records.append("# stopped")
+        return interp.records
+    allocated = re.compile(r"%s\d+" % re.escape(cfg.scoreboard))
+    default_scb = cfg.scoreboard + "1"
+    for (holder, objective), value in sorted(interp.scores.items()):
+        if not (objective == default_scb and allocated.fullmatch(holder)):
+            interp.record("score %s %s = %d" % (holder, objective, value))
+    return interp.records
+
+def check(path: str) -> bool:
+    res = []
+    for optimizer in (False, True):
+        cfg = Config(optimizer=optimizer)
+        files = Compiler(path, cfg).render()
+        res.append(simulate(files, cfg))
+    plain, optimized = res
+    if plain[-1] == "# stopped" or optimized[-1] == "# stopped":
+        # Compare only the part that both of them got to
+        length = min(len(plain), len(optimized)) - 1
+        plain, optimized = plain[:length], optimized[:length]
+    if plain == optimized:
+        print("OK: %s (%d records)" % (os.path.relpath(path, ROOT),
+                                       len(plain)))
+        return True
+    for i, (a, b) in enumerate(zip(plain, optimized)):
+        if a != b:
+            break
+    else:
+        i = min(len(plain), len(optimized))
+    print("MISMATCH: %s at record %d" % (path, i))
+    print("  without optimizer: %s" % plain[i:i + 3])
+    print("  with optimizer:    %s" % optimized[i:i + 3])
+    return False
+
+def check_case(name: str, source: str, expected: List[str]) -> bool:
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "case.aca")
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(source)
+        ok = True
+        for optimizer in (False, True):
+            cfg = Config(optimizer=optimizer)
+            records = [
+                record
+                for record in simulate(Compiler(path, cfg).render(), cfg)[1:]
+                if record.startswith("say ")
+                or (record.startswith("score ")
+                    and not record.startswith("score @"))
+            ]
+            if records != expected:
+                print("WRONG: %s (optimizer %s)" % (name, optimizer))
+                print("  expected: %s" % expected)
+                print("  got:      %s" % records)
+                ok = False
+    if ok:
+        print("OK: %s" % name)
+    return ok
+
+def main():
+    if sys.argv[1:]:
+        files, cases = sys.argv[1:], []
+    else:
+        files = sorted(
+            glob.glob(os.path.join(ROOT, "test", "demo", "*.aca"))
+            + [os.path.join(ROOT, "test", "brief.aca")]
+        )
+        cases = CASES
+    ok = all([check(path) for path in files]
+             + [check_case(*case) for case in cases])
+    if not ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
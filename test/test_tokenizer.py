@@ -0,0 +1,116 @@
+# Differential test of the tokenizer
+# Check that the tokenizer produces the same tokens (or error) as
+# another version of it in Git history, and compare their speed.
+# Usage: python test_tokenizer.py [REV] [FILES...]
+# REV defaults to the last commit whose tokenizer is different from
+# the current one; FILES default to all the Acacia files in this
+# directory and the demos.
+
+# Add `acaciamc` directory to path
+import os
+import sys
+ROOT = os.path.realpath(os.path.join(__file__, os.pardir, os.pardir))
+sys.path.append(ROOT)
+
+import glob
+import io
+import subprocess
+import time
+import types
+from typing import List, Tuple
+
+from acaciamc.tokenizer import Tokenizer, TokenType
+from acaciamc.error import Error
+
+MC_VERSION = (1, 20, 10)
+TOKENIZER_PATH = "acaciamc/tokenizer.py"
+REPEAT = 10
+
+def git(*args: str) -> str:
+    return subprocess.run(
+        ("git",) + args, cwd=ROOT, check=True,
+        stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout
+
+def find_reference_rev() -> str:
+    with open(os.path.join(ROOT, TOKENIZER_PATH), encoding="utf-8") as f:
+        current = f.read()
+    for rev in git("rev-list", "HEAD", "--", TOKENIZER_PATH).split():
+        if git("show", f"{rev}:{TOKENIZER_PATH}") != current:
+            return rev
+    sys.exit("no other version of tokenizer found in history")
+
+def load_tokenizer(rev: str) -> type:
+    module = types.ModuleType(f"acaciamc.tokenizer@{rev}")
+    exec(git("show", f"{rev}:{TOKENIZER_PATH}"), module.__dict__)
+    return module.Tokenizer
+
+def tokenize(cls: type, src: str) -> Tuple[List[tuple], str]:
+    """Return tokens in `src` and the error message (if any)."""
+    tokenizer = cls(io.StringIO(src), MC_VERSION)
+    tokens = []
+    try:
+        while True:
+            token = tokenizer.get_next_token()
+            # Compare token types by name since the two versions have
+            # different `TokenType` classes.
+            tokens.append((token.type.name, token.lineno,
+                           token.col, token.value))
+            if token.type.name == TokenType.end_marker.name:
+                break
+    except Error as err:
+        return tokens, err.full_msg()
+    return tokens, ""
+
+def timeit(cls: type, src: str) -> float:
+    """
+    Best time of `REPEAT` runs (the least noisy one) to read all tokens
+    in `src`, which must have no error.
+    """
+    end_marker = cls.__init__.__globals__["TokenType"].end_marker
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        tokenizer = cls(io.StringIO(src), MC_VERSION)
+        while tokenizer.get_next_token().type is not end_marker:
+            pass
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    argv = sys.argv[1:]
+    rev = argv.pop(0) if argv else find_reference_rev()
+    files = argv or sorted(
+        glob.glob(os.path.join(ROOT, "test", "*.aca"))
+        + glob.glob(os.path.join(ROOT, "test", "demo", "*.aca"))
+    )
+    old_cls = load_tokenizer(rev)
+    print(f"Comparing with tokenizer at {rev}")
+    failed = False
+    old_total = new_total = 0.0
+    for path in files:
+        with open(path, encoding="utf-8") as f:
+            src = f.read()
+        # Also check sources that end without a new line
+        for variant in (src, src.rstrip("\n")):
+            old_res = tokenize(old_cls, variant)
+            if old_res != tokenize(Tokenizer, variant):
+                print(f"MISMATCH: {path}")
+                failed = True
+                break
+        if old_res[1]:
+            # Sources with errors are only compared, not timed
+            continue
+        old_time = timeit(old_cls, src)
+        new_time = timeit(Tokenizer, src)
+        old_total += old_time
+        new_total += new_time
+        print(f"{os.path.relpath(path, ROOT)}: {old_time * 1000:.2f}ms -> "
+              f"{new_time * 1000:.2f}ms")
+    print(f"Total: {old_total * 1000:.2f}ms -> {new_total * 1000:.2f}ms "
+          f"({old_total / new_total:.2f}x)")
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()